@@ -1,22 +1,47 @@
 import json
 import logging
 import os
+import time
+from collections import namedtuple
 from datetime import datetime, timedelta
+from itertools import islice
 
 import asyncio
-import requests
-import aiohttp
 from sqlalchemy import update
 
 from database import Session
+from .http_client import SharedHttpClient
+from .metrics import metrics
+from .resilience import async_call_with_retry
+from .status_cache import status_cache
 from models import Receipt, PaidStatusEnum, StatusSudEnum
 from sqlalchemy import and_
 
 
 logger = logging.getLogger(__name__)
 
+ReceiptRecord = namedtuple('ReceiptRecord', [
+    'id', 'fio', 'name_of_region', 'id_sud', 'name_of_client', 'stir_of_client', 'sum_of_debt',
+    'pinfl_of_debtor', 'address_of_client',
+])
+
+CreatedReceipt = namedtuple('CreatedReceipt', ['id', 'pinfl_of_debtor', 'invoice', 'sum_of_receipt', 'link_of_receipt'])
+
+
+# Размер пачки для Receipt.id.in_(...): большие выборки оператора делятся на несколько запросов
+ID_CHUNK_SIZE = 1000
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
 class Mixin:
     FOLDER_PATH_BASE = os.getcwd()
+    BASE_URL = 'https://***'
+    rate_limiter = None
     HEADERS = {
         "Accept": "application/json, text/plain, */*",
         "Accept-Encoding": "gzip, deflate, br",
@@ -32,6 +57,56 @@ class Mixin:
         "sec-ch-ua-platform": '"Windows"'
     }
 
+    @staticmethod
+    def run_in_loop(coro):
+        return SharedHttpClient.run(coro)
+
+    async def get_http_session(self):
+        return await SharedHttpClient.get_session()
+
+    def get_requests_session(self):
+        return SharedHttpClient.get_requests_session()
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов: rate запросов в секунду, burst - размер пачки."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def async_acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                wait = self._take()
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+
 
 class GetDataDB:
     def __init__(self, user_id, type_of_receipt):
@@ -44,81 +119,183 @@ class GetDataDB:
             percent_of_summ = 375000
         return percent_of_summ
 
+    def iter_data_from_db_to_create_receipts(self, batch_size=1000, pinfls=None):
+        """Строки для создания квитанций страницами по id.
+
+        Каждая страница читается своей короткой сессией: создание идет часами с ограничением скорости,
+        и открытый курсор держал бы транзакцию все это время.
+        """
+        last_id = None
+        while True:
+            session = Session()
+            try:
+                query = session.query(
+                    Receipt.id, Receipt.fio, Receipt.name_of_region, Receipt.id_sud, Receipt.name_of_client,
+                    Receipt.stir_of_client, Receipt.sum_of_debt, Receipt.sum_of_receipt, Receipt.pinfl_of_debtor,
+                    Receipt.address_of_client,
+                ).filter_by(status_of_created=False,
+                            type_of_sud=self.type_of_receipt,
+                            paid=PaidStatusEnum.NOT_CREATED,
+                            user_id=self.user_id)
+                if pinfls is not None:
+                    query = query.filter(Receipt.pinfl_of_debtor.in_(pinfls))
+                if last_id is not None:
+                    query = query.filter(Receipt.id > last_id)
+                with metrics.timer('db_query_seconds', operation='select_to_create'):
+                    rows = query.order_by(Receipt.id).limit(batch_size).all()
+            finally:
+                session.close()
+
+            for row in rows:
+                if row.sum_of_receipt is not None:
+                    # Сумма посчитана при загрузке борда
+                    sum_of_debt = row.sum_of_receipt
+                elif self.type_of_receipt == StatusSudEnum.CIVIL:
+                    sum_of_debt = self.get_correct_amount(row.sum_of_debt)
+                else:
+                    sum_of_debt = row.sum_of_debt
+
+                yield ReceiptRecord(
+                    id=row.id,
+                    fio=row.fio,
+                    name_of_region=row.name_of_region,
+                    id_sud=row.id_sud,
+                    name_of_client=row.name_of_client,
+                    stir_of_client=row.stir_of_client,
+                    sum_of_debt=sum_of_debt,
+                    pinfl_of_debtor=row.pinfl_of_debtor,
+                    address_of_client=row.address_of_client,
+                )
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1].id
+
     def get_data_from_db_to_create_receipts(self):
-        session = Session()
-        rows = session.query(Receipt).filter_by(status_of_created=False,
-                                                type_of_sud=self.type_of_receipt,
-                                                paid=PaidStatusEnum.NOT_CREATED,
-                                                user_id=self.user_id).all()
-        session.close()
-
-        _dict = {}
-        for row in rows:
-            if self.type_of_receipt == StatusSudEnum.CIVIL:
-                sum_of_debt = self.get_correct_amount(row.sum_of_debt)
-            else:
-                sum_of_debt = row.sum_of_debt
-
-            _dict[f'{row.id}'] = {
-                'fio': row.fio,
-                'name_of_region': row.name_of_region,
-                'id_sud': row.id_sud,
-                'name_of_client': row.name_of_client,
-                'stir_of_client': row.stir_of_client,
-                'sum_of_debt': sum_of_debt,
-                'pinfl_of_debtor': row.pinfl_of_debtor,
-                'address_of_client': row.address_of_client,
-            }
-
-        return _dict
+        return list(self.iter_data_from_db_to_create_receipts())
 
-    def get_data_from_db_for_download_pdf_today(self, ids, check=False):
+    def iter_data_from_db_for_download_pdf_today(self, ids, check=False, batch_size=1000):
         session = Session()
         _filter = [
             Receipt.type_of_sud == self.type_of_receipt,
             Receipt.user_id == self.user_id,
-            Receipt.id.in_(ids)
         ]
-        if not check:
-            _filter.append(Receipt.paid == PaidStatusEnum.PAID)
-        rows = session.query(Receipt).filter(
-            and_(
-                *_filter
-            )
-        ).all()
-        session.close()
-
-        data = []
         if check:
-            for row in rows:
-                data.append((row.fio, row.paid, row.pinfl_of_debtor, row.number_of_receipt))
+            columns = (Receipt.fio, Receipt.paid, Receipt.pinfl_of_debtor, Receipt.number_of_receipt)
         else:
-            for row in rows:
-                data.append((row.fio, row.pinfl_of_debtor, row.number_of_receipt))
-        return data
+            _filter.append(Receipt.paid == PaidStatusEnum.PAID)
+            columns = (Receipt.fio, Receipt.pinfl_of_debtor, Receipt.number_of_receipt)
+        try:
+            for ids_chunk in batched(sorted(set(ids)), ID_CHUNK_SIZE):
+                rows = session.query(*columns).filter(
+                    and_(
+                        *_filter,
+                        Receipt.id.in_(ids_chunk)
+                    )
+                ).yield_per(batch_size)
+                for row in rows:
+                    yield tuple(row)
+        finally:
+            session.close()
+
+    def get_data_from_db_for_download_pdf_today(self, ids, check=False):
+        with metrics.timer('db_query_seconds', operation='select_to_download'):
+            return list(self.iter_data_from_db_for_download_pdf_today(ids, check=check))
+
+
+class FolderIndex:
+    """Индекс id -> name по json файлам папки. Пересобирается при изменении mtime/размера файлов.
+
+    Папка проверяется не чаще раза в refresh_interval секунд, остальные обращения - поиск в словаре.
+    """
+    INDEX_FILE_NAME = '.index_cache'
+
+    def __init__(self, folder_path, persist=False, refresh_interval=5.0):
+        self.folder_path = folder_path
+        self.persist = persist
+        self.refresh_interval = refresh_interval
+        self.signature = None
+        self.checked_at = None
+        self.index = {}
 
+    def _get_signature(self):
+        signature = []
+        with os.scandir(self.folder_path) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    signature.append([entry.name, stat.st_mtime_ns, stat.st_size])
+        return sorted(signature)
 
-def read_files_in_folder(folder_path, id):
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith('.json'):
-            file_path = os.path.join(folder_path, file_name)
-            with open(file_path, 'r', encoding='utf-8') as file:
+    def _load_persisted(self, signature):
+        path = os.path.join(self.folder_path, self.INDEX_FILE_NAME)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
                 data = json.load(file)
-                for obj in data:
-                    if obj['id'] == id:
-                        return obj['name']
+        except (OSError, ValueError):
+            return False
+        if data.get('signature') != signature:
+            return False
+        self.index = dict(data['index'])
+        return True
+
+    def _save_persisted(self, signature):
+        path = os.path.join(self.folder_path, self.INDEX_FILE_NAME)
+        try:
+            with open(path, 'w', encoding='utf-8') as file:
+                json.dump({'signature': signature, 'index': list(self.index.items())},
+                          file, ensure_ascii=False, separators=(',', ':'))
+        except OSError as e:
+            logger.error(f"Не удалось сохранить индекс папки {self.folder_path}: {e}")
+
+    def _build(self):
+        index = {}
+        for file_name in sorted(os.listdir(self.folder_path)):
+            if file_name.endswith('.json'):
+                file_path = os.path.join(self.folder_path, file_name)
+                with open(file_path, 'r', encoding='utf-8') as file:
+                    for obj in json.load(file):
+                        index.setdefault(obj['id'], obj['name'])
+        self.index = index
+
+    def refresh(self):
+        self.checked_at = time.monotonic()
+        signature = self._get_signature()
+        if signature == self.signature:
+            return
+        if not (self.persist and self._load_persisted(signature)):
+            self._build()
+            if self.persist:
+                self._save_persisted(signature)
+        self.signature = signature
+
+    def get(self, id):
+        if self.checked_at is None or time.monotonic() - self.checked_at >= self.refresh_interval:
+            self.refresh()
+        return self.index.get(id)
+
+
+_folder_indexes = {}
+
+
+def read_files_in_folder(folder_path, id, persist=False):
+    folder_index = _folder_indexes.get(folder_path)
+    if folder_index is None:
+        folder_index = _folder_indexes[folder_path] = FolderIndex(folder_path, persist=persist)
+    return folder_index.get(id)
 
 
 class CheckPaidReceipt(Mixin):
-    def __init__(self, user_id, type_of_sud, ids=None, is_self_paid=False):
+    def __init__(self, user_id, type_of_sud, ids=None, is_self_paid=False, sliding_window=None, rate_limiter=None):
         self.type_of_sud = type_of_sud
+        self.rate_limiter = rate_limiter
+        self.sliding_window = sliding_window
         self.user_id = user_id
         self.ids = None
         if ids is not None:
             self.ids = ids
         self.is_self_paid = is_self_paid
 
-    def get_receipts_to_check_paid(self):
+    def iter_receipts_to_check_paid(self, batch_size=1000):
         session = Session()
         filter_list = [
             Receipt.status_of_created == True,
@@ -126,42 +303,53 @@ class CheckPaidReceipt(Mixin):
             Receipt.paid.in_([PaidStatusEnum.CHECKING, PaidStatusEnum.CREATED]),
             Receipt.user_id == self.user_id,
         ]
-        if self.ids is not None:
-            filter_list.append(Receipt.id.in_(self.ids))
-        rows = session.query(Receipt).filter(
-            and_(
-                *filter_list
-            )
-        ).all()
-        session.close()
+        id_chunks = [None] if self.ids is None else batched(sorted(set(self.ids)), ID_CHUNK_SIZE)
+        try:
+            for ids_chunk in id_chunks:
+                chunk_filter = filter_list if ids_chunk is None else filter_list + [Receipt.id.in_(ids_chunk)]
+                rows = session.query(Receipt.id, Receipt.number_of_receipt).filter(
+                    and_(
+                        *chunk_filter
+                    )
+                ).yield_per(batch_size)
+                for row in rows:
+                    yield tuple(row)
+        finally:
+            session.close()
 
-        data = []
-        for row in rows:
-            data.append((row.id, row.number_of_receipt))
+    def get_receipts_to_check_paid(self):
+        with metrics.timer('db_query_seconds', operation='select_to_check'):
+            return list(self.iter_receipts_to_check_paid())
 
-        return data
+    async def _fetch_status(self, url, headers, session):
+        if self.rate_limiter is not None:
+            await self.rate_limiter.async_acquire()
+        async with session.get(url, headers=headers, timeout=120) as response:
+            response.raise_for_status()
+            if response.status == 200:
+                return await response.json()
 
     async def _request(self, data, headers, session, results):
-        url = f"https://***/api/invoice/checkStatus?invoice={data[1]}&lang=ruName"
+        url = f"{self.BASE_URL}/api/invoice/checkStatus?invoice={data[1]}&lang=ruName"
         _receipt_update = {'id': data[0], 'paid': None}
         if self.is_self_paid:
             _receipt_update['receipt_paid_at'] = datetime.now()
         try:
-            async with session.get(url, headers=headers, timeout=120) as response:
-                response.raise_for_status()
-
-                if response.status == 200:
-                    response_data = await response.json()
-                    if response_data.get('invoiceStatus') == 'PAID':
-                        logger.info(f"Квитанция {response_data.get('number')} оплачена")
-                        _receipt_update['paid'] = 'PAID'
-                        results.append(_receipt_update)
-                    elif response_data.get('invoiceStatus') == 'CHECKING':
-                        logger.info(f"Квитанция {response_data.get('number')} проверяется")
-                        _receipt_update['paid'] = 'CHECKING'
-                        results.append(_receipt_update)
-                    else:
-                        logger.error(f'Для квитанции - {data[1]}, статус оплаты не изменился.')
+            response_data = await status_cache.get_status(
+                data[1], lambda: async_call_with_retry('check', self._fetch_status, url, headers, session)
+            )
+
+            if response_data is not None:
+                if response_data.get('invoiceStatus') == 'PAID':
+                    logger.info(f"Квитанция {response_data.get('number')} оплачена")
+                    _receipt_update['paid'] = 'PAID'
+                    results.append(_receipt_update)
+                elif response_data.get('invoiceStatus') == 'CHECKING':
+                    logger.info(f"Квитанция {response_data.get('number')} проверяется")
+                    _receipt_update['paid'] = 'CHECKING'
+                    results.append(_receipt_update)
+                else:
+                    logger.error(f'Для квитанции - {data[1]}, статус оплаты не изменился.')
 
         except Exception as e:
             logger.error(f"Не удалось проверить квитанцию,\nОшибка: {e}",
@@ -172,27 +360,80 @@ class CheckPaidReceipt(Mixin):
         results = []
         tasks = []
         data_blocks = [data[i:i + 20] for i in range(0, len(data), 20)]
-        async with aiohttp.ClientSession() as session:
-            for block in data_blocks:
-                tasks.extend(
-                    [self._request(_data, headers, session, results) for _data in block]
-                )
-                await asyncio.gather(*tasks)
+        session = await self.get_http_session()
+        for block in data_blocks:
+            tasks.extend(
+                [self._request(_data, headers, session, results) for _data in block]
+            )
+            await asyncio.gather(*tasks)
+
+            if results:
+                self._update_paid_receipts_in_db(results)
+
+            results.clear()
+            tasks.clear()
 
-                if results:
-                    self._update_paid_receipts_in_db(results)
+    async def _check_worker(self, data_queue, results_queue, headers, session):
+        while True:
+            _data = await data_queue.get()
+            if _data is None:
+                return
+            metrics.set_gauge('check_queue_depth', data_queue.qsize(), queue='requests')
+            results = []
+            await self._request(_data, headers, session, results)
+            for result in results:
+                results_queue.put_nowait(result)
+            metrics.set_gauge('check_queue_depth', results_queue.qsize(), queue='db_writer')
 
-                results.clear()
-                tasks.clear()
+    async def _db_writer(self, results_queue, batch_size, flush_interval):
+        loop = asyncio.get_running_loop()
+        batch = []
+        finished = False
+        while not finished:
+            deadline = loop.time() + flush_interval
+            while len(batch) < batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    result = await asyncio.wait_for(results_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if result is None:
+                    finished = True
+                    break
+                batch.append(result)
+            if batch:
+                await asyncio.to_thread(self._update_paid_receipts_in_db, batch[:])
+                batch.clear()
+
+    async def api_request_to_check_receipt_sliding(self, data, window=20, batch_size=100, flush_interval=2.0):
+        """Проверка с постоянным числом запросов в работе, запись в БД идет отдельной задачей."""
+        headers = self.HEADERS.copy()
+        data_queue = asyncio.Queue()
+        results_queue = asyncio.Queue()
+        for _data in data:
+            data_queue.put_nowait(_data)
+        for _ in range(window):
+            data_queue.put_nowait(None)
+
+        writer = asyncio.create_task(self._db_writer(results_queue, batch_size, flush_interval))
+        session = await self.get_http_session()
+        await asyncio.gather(
+            *[self._check_worker(data_queue, results_queue, headers, session) for _ in range(window)]
+        )
+        results_queue.put_nowait(None)
+        await writer
 
     def _update_paid_receipts_in_db(self, results):
         session = Session()
         try:
-            session.execute(
-                update(Receipt),
-                results
-            )
-            session.commit()
+            with metrics.timer('db_commit_seconds', operation='update_paid'):
+                session.execute(
+                    update(Receipt),
+                    results
+                )
+                session.commit()
         except Exception as e:
             session.rollback()
             logger.error(f"Ошибка обновления квитанций: {e}",
@@ -201,13 +442,26 @@ class CheckPaidReceipt(Mixin):
             session.close()
 
     def process(self):
+        with metrics.timer('stage_seconds', stage='check'):
+            self._process()
+
+    def _process(self):
         data_receipts_to_check = self.get_receipts_to_check_paid()
         if not data_receipts_to_check:
             logger.info(f'Данные для проверки не найдены.')
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.api_request_to_check_receipt(data_receipts_to_check))
+        if self.sliding_window:
+            self.run_in_loop(
+                self.api_request_to_check_receipt_sliding(data_receipts_to_check, window=self.sliding_window)
+            )
+        else:
+            self.run_in_loop(self.api_request_to_check_receipt(data_receipts_to_check))
 
 
-def run_check_paid_receipt(user_id, type_of_receipt, ids=None, is_self_paid=False):
-    CheckPaidReceipt(user_id, type_of_receipt, ids=ids, is_self_paid=is_self_paid).process()
+def run_check_paid_receipt(user_id, type_of_receipt, ids=None, is_self_paid=False, sliding_window=None,
+                           rate_limiter=None):
+    SharedHttpClient.enter()
+    try:
+        CheckPaidReceipt(user_id, type_of_receipt, ids=ids, is_self_paid=is_self_paid,
+                         sliding_window=sliding_window, rate_limiter=rate_limiter).process()
+    finally:
+        SharedHttpClient.leave()
@@ -0,0 +1,81 @@
+import asyncio
+import itertools
+import random
+import threading
+
+from aiohttp import web
+
+
+class MockBillingServer:
+    """Локальная замена биллинга для замеров: create, checkStatus и asDocument с настраиваемой задержкой и ошибками."""
+
+    def __init__(self, latency=0.05, error_rate=0.0, pdf_size=50 * 1024, paid_rate=1.0, port=0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.pdf_size = pdf_size
+        self.paid_rate = paid_rate
+        self.port = port
+        self.random = random.Random(seed)
+        self.invoices = itertools.count(100000000)
+        self.pdf = b'%PDF-1.4\n' + b'0' * max(0, pdf_size - 9)
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._started = threading.Event()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.random.expovariate(1 / self.latency))
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': '0'})
+
+    async def create(self, request):
+        await request.json()
+        await self._delay()
+        return web.json_response({'invoice': str(next(self.invoices))}, status=201)
+
+    async def check_status(self, request):
+        await self._delay()
+        invoice = request.query.get('invoice')
+        status = 'PAID' if self.random.random() < self.paid_rate else 'CHECKING'
+        return web.json_response({'invoiceStatus': status, 'number': invoice})
+
+    async def as_document(self, request):
+        await self._delay()
+        return web.Response(body=self.pdf, content_type='application/pdf')
+
+    def _make_app(self):
+        app = web.Application()
+        app.router.add_post('/api/invoice/create', self.create)
+        app.router.add_get('/api/invoice/checkStatus', self.check_status)
+        app.router.add_get('/api/invoice/asDocument', self.as_document)
+        return app
+
+    async def _start(self):
+        self._runner = web.AppRunner(self._make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        self._started.set()
+
+    def _serve(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._start())
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, name='mock-billing-server', daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -0,0 +1,178 @@
+"""Замеры скорости этапов создания, проверки оплаты и скачивания на локальном мок-сервере и SQLite.
+
+Запуск: python -m <package>.benchmarks.run_benchmarks --sizes 1000 10000 --latency 0.05
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import statistics
+import tempfile
+import time
+
+import aiohttp
+from sqlalchemy import create_engine
+
+from database import Session
+from models import Receipt, PaidStatusEnum, StatusSudEnum
+from ..base import CheckPaidReceipt, GetDataDB, Mixin
+from ..creation_post_receipts_civil import CreateReceiptAPI
+from ..download_created_receipts import DownloadCreatedReceipt
+from ..http_client import SharedHttpClient
+from ..resilience import RETRY_POLICIES
+from .mock_billing_server import MockBillingServer
+
+STAGES = ('create', 'check', 'download')
+USER_ID = 1
+
+
+def _make_latency_trace(latencies):
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        context.started_at = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        latencies.append(time.perf_counter() - context.started_at)
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+def seed_db(db_path, stage, size):
+    engine = create_engine(f'sqlite:///{db_path}')
+    Receipt.metadata.create_all(engine)
+    Session.configure(bind=engine)
+
+    created = stage != 'create'
+    paid = {'create': PaidStatusEnum.NOT_CREATED, 'check': PaidStatusEnum.CREATED, 'download': PaidStatusEnum.PAID}[stage]
+    session = Session()
+    session.bulk_insert_mappings(Receipt, [
+        {
+            'name_of_region': 'Регион',
+            'id_sud': 1,
+            'name_of_client': 'Клиент',
+            'stir_of_client': '123456789',
+            'fio': f'Должник {i}',
+            'sum_of_debt': 10000000,
+            'pinfl_of_debtor': f'{i:014d}',
+            'address_of_client': 'Адрес',
+            'type_of_sud': StatusSudEnum.CIVIL,
+            'status_of_created': created,
+            'number_of_receipt': str(100000000 + i) if created else None,
+            'paid': paid,
+            'user_id': USER_ID,
+        }
+        for i in range(size)
+    ])
+    session.commit()
+    ids = [row.id for row in session.query(Receipt.id)]
+    session.close()
+    return ids
+
+
+def count_done(stage, downloader=None):
+    """Сколько строк этап действительно довел до конца: без этого замер с неудачной записью в БД выглядит успешным."""
+    if stage == 'download':
+        return len(downloader.manifest.entries)
+    session = Session()
+    try:
+        if stage == 'create':
+            return session.query(Receipt).filter(Receipt.status_of_created == True).count()
+        return session.query(Receipt).filter(Receipt.paid == PaidStatusEnum.PAID).count()
+    finally:
+        session.close()
+
+
+def run_stage(stage, size, base_url, concurrency, results):
+    logging.disable(logging.CRITICAL)
+    Mixin.BASE_URL = base_url
+    latencies = []
+    SharedHttpClient.TRACE_CONFIGS = [_make_latency_trace(latencies)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ids = seed_db(os.path.join(tmp_dir, 'bench.sqlite3'), stage, size)
+        downloader = None
+        started_at = time.perf_counter()
+        if stage == 'create':
+            # Открытый курсор чтения SQLite не дал бы закоммитить запись статусов с другого соединения
+            data = GetDataDB(USER_ID, StatusSudEnum.CIVIL).get_data_from_db_to_create_receipts()
+            api = CreateReceiptAPI(data, USER_ID, StatusSudEnum.CIVIL, rate=1e9, burst=concurrency,
+                                   concurrency=concurrency)
+            api.run_in_loop(api.async_process_create_receipts())
+        elif stage == 'check':
+            CheckPaidReceipt(USER_ID, StatusSudEnum.CIVIL, sliding_window=concurrency).process()
+        else:
+            downloader = DownloadCreatedReceipt(USER_ID, StatusSudEnum.CIVIL, tmp_dir)
+            downloader.run_in_loop(downloader.async_process_for_download_pdf(ids))
+        elapsed = time.perf_counter() - started_at
+        SharedHttpClient.close()
+        done = count_done(stage, downloader)
+
+    latencies.sort()
+    results.put({
+        'stage': stage,
+        'size': size,
+        'done': done,
+        'seconds': elapsed,
+        'throughput': size / elapsed if elapsed else 0,
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else 0,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0,
+        'requests': len(latencies),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры этапов работы с квитанциями')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--pdf-size', type=int, default=50 * 1024)
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    for policy in RETRY_POLICIES.values():
+        policy.max_delay = 0.1
+
+    server = MockBillingServer(latency=args.latency, error_rate=args.error_rate, pdf_size=args.pdf_size).start()
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    failed = []
+    print(f"{'stage':<10}{'size':>8}{'done':>8}{'sec':>10}{'rps':>10}{'p50 ms':>10}{'p99 ms':>10}{'rss MB':>10}")
+    try:
+        for stage in args.stages:
+            for size in args.sizes:
+                # Каждый замер в отдельном процессе, чтобы peak RSS относился только к нему
+                process = context.Process(target=run_stage,
+                                          args=(stage, size, server.base_url, args.concurrency, results))
+                process.start()
+                result = None
+                while result is None:
+                    try:
+                        result = results.get(timeout=1)
+                    except queue.Empty:
+                        if not process.is_alive():
+                            break
+                process.join()
+                if result is None:
+                    print(f"{stage:<10}{size:>8}  процесс замера завершился с кодом {process.exitcode}")
+                    failed.append((stage, size))
+                    continue
+                print(f"{result['stage']:<10}{result['size']:>8}{result['done']:>8}{result['seconds']:>10.2f}"
+                      f"{result['throughput']:>10.1f}{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}"
+                      f"{result['peak_rss_mb']:>10.1f}")
+                if result['done'] != size:
+                    failed.append((stage, size))
+    finally:
+        server.stop()
+    if failed:
+        raise SystemExit(f"Замеры не обработали все строки: {failed}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,29 @@
+import asyncio
 import logging
-import time
+from itertools import chain
 
 from database import Session
 from exceptions.pages_exceptions import CreateReceiptErrorException
 from exceptions.pages_exceptions import EmptyDBDataException
 from models import Receipt, PaidStatusEnum
 from datetime import datetime
-import requests
 import os
 
-from openpyxl.reader.excel import load_workbook
-from openpyxl.workbook import Workbook
+from sqlalchemy import update
 
-from config.modal_log_handler import ModalLogHandler
 from .base import GetDataDB
 
 from .base import Mixin
+from .base import TokenBucket
+from .base import CreatedReceipt, batched
 
 from .base import read_files_in_folder
+from .http_client import SharedHttpClient
+from .journal import CreationJournal
+from .log_queue import attach_modal_log_handler, detach_modal_log_handler
+from .metrics import metrics
+from .report_writer import ReportWriterMixin
+from .resilience import call_with_retry, async_call_with_retry, get_status
 from models import StatusSudEnum
 
 logger = logging.getLogger(__name__)
@@ -37,39 +43,68 @@ class UpdateReceiptsStatus:
 
     def update_status_in_db(self, data_block):
         self.data_block = data_block
-        for v in data_block:
-            session = Session()
-            try:
-                pinfl_of_debtor = v.get('pinfl_of_debtor')
-                receipt = session.query(Receipt).filter_by(pinfl_of_debtor=pinfl_of_debtor,
-                                                           status_of_created=False,
-                                                           type_of_sud=self.type_of_receipt,
-                                                           user_id=self.user_id).first()
-                if receipt:
-                    receipt.status_of_created = True
-                    receipt.number_of_receipt = v.get('invoice')
-                    receipt.sum_of_receipt = v.get('sum_of_receipt')
-                    receipt.link_of_receipt = v.get('link_of_receipt')
-                    receipt.paid = PaidStatusEnum.CREATED
-                    receipt.receipt_created_at = datetime.now()
+        if not data_block:
+            return []
+        updated = []
+        session = Session()
+        try:
+            pinfls = [created_receipt.pinfl_of_debtor for created_receipt in data_block]
+            rows = session.query(Receipt.id, Receipt.pinfl_of_debtor).filter(
+                Receipt.pinfl_of_debtor.in_(pinfls),
+                Receipt.status_of_created == False,
+                Receipt.type_of_sud == self.type_of_receipt,
+                Receipt.user_id == self.user_id,
+            ).all()
+            ids_by_pinfl = {pinfl: _id for _id, pinfl in rows}
+
+            created_at = datetime.now()
+            updates = []
+            for created_receipt in data_block:
+                pinfl_of_debtor = created_receipt.pinfl_of_debtor
+                receipt_id = ids_by_pinfl.pop(pinfl_of_debtor, None)
+                if receipt_id is None:
+                    logger.error(f"Квитанция с ПИНФЛ {pinfl_of_debtor} не найдена или уже была создана",
+                                 extra={"user_message": "Ошибка обновления строки в БД."})
+                    continue
+                updated.append(created_receipt)
+                updates.append({
+                    'id': receipt_id,
+                    'status_of_created': True,
+                    'number_of_receipt': created_receipt.invoice,
+                    'sum_of_receipt': created_receipt.sum_of_receipt,
+                    'link_of_receipt': created_receipt.link_of_receipt,
+                    'paid': PaidStatusEnum.CREATED,
+                    'receipt_created_at': created_at,
+                })
+
+            if updates:
+                with metrics.timer('db_commit_seconds', operation='update_created'):
+                    session.execute(update(Receipt), updates)
                     session.commit()
-                else:
-                    logger.error(f"Квитанция с ПИНФЛ {pinfl_of_debtor} не найдена или уже была создана")
-                    raise Exception(f"Квитанция с ПИНФЛ {pinfl_of_debtor} не найдена или уже была создана.")
-            except Exception as e:
-                logger.error(f"Ошибка обновления строки в БД: {e}",
-                             extra={"user_message": "Ошибка обновления строки в БД."})
-                session.rollback()
-            finally:
-                session.close()
+        except Exception as e:
+            logger.error(f"Ошибка обновления строк в БД: {e}",
+                         extra={"user_message": "Ошибка обновления строк в БД."})
+            session.rollback()
+            updated = []
+        finally:
+            session.close()
+        return updated
 
 
-class CreateReceiptAPI(Mixin):
+class CreateReceiptAPI(ReportWriterMixin, Mixin):
+    REPORT_HEADERS = ['ФИО', 'Пинфл должника', 'Номер квитанции', 'Название региона', 'Сумма квитанции', 'Ссылка на квитанцию']
 
-    def __init__(self, data, user_id, type_of_receipt):
+    def __init__(self, data, user_id, type_of_receipt, rate=0.5, burst=1, concurrency=5, journal=None,
+                 rate_limiter=None):
         self.data = data
         self.user_id = user_id
         self.type_of_receipt = type_of_receipt
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.db_batch_size = 50
+        self.report_writers = {}
+        self.journal = journal
+        self.on_committed = None
 
         self.type_name_of_output()
 
@@ -81,14 +116,14 @@ class CreateReceiptAPI(Mixin):
             self.name_of_created_excel = 'created_receipts_info_post.xlsx'
             self.name_of_not_created_excel = 'not_created_receipts_info_post.xlsx'
 
-    def request_create_receipt(self, court_id, pinfl_of_debtor, name_of_client, stir_of_client, address_of_client, sum_of_debt):
-        time.sleep(2)
+    def _get_request_headers(self):
         headers = self.HEADERS.copy()
-        headers['Referer'] = 'https://***/create-receipt'
-        headers['Origin'] = 'https://***'
+        headers['Referer'] = f'{self.BASE_URL}/create-receipt'
+        headers['Origin'] = self.BASE_URL
         headers['Content-Type'] = 'application/json'
-        headers['Content-Length'] = '371'
+        return headers
 
+    def _get_request_body(self, court_id, name_of_client, stir_of_client, address_of_client, sum_of_debt):
         body = {
             "entityType": "JURIDICAL",
             "juridicalEntity": {
@@ -109,9 +144,24 @@ class CreateReceiptAPI(Mixin):
             body["payCategoryId"] = 1
         else:
             body["payCategoryId"] = 3
+        return body
 
-        response = requests.post('https://***/api/invoice/create', json=body, headers=headers)
+    def _post_create(self, body, headers, receipt_id=None, pinfl_of_debtor=None):
+        # Токен берется на каждую попытку, повторы после 429/503 тоже идут через общий лимит
+        self.rate_limiter.acquire()
+        if receipt_id is not None:
+            # intent пишется прямо перед запросом: ожидание лимита или паузы автомата не оставляет сомнений
+            self._journal('intent', receipt_id, pinfl_of_debtor)
+        response = self.get_requests_session().post(f'{self.BASE_URL}/api/invoice/create', json=body, headers=headers)
         response.raise_for_status()
+        return response
+
+    def request_create_receipt(self, court_id, pinfl_of_debtor, name_of_client, stir_of_client, address_of_client, sum_of_debt,
+                               receipt_id=None):
+        headers = self._get_request_headers()
+        body = self._get_request_body(court_id, name_of_client, stir_of_client, address_of_client, sum_of_debt)
+
+        response = call_with_retry('create', self._post_create, body, headers, receipt_id, pinfl_of_debtor)
         if response.status_code == 201:
             logger.info(f"Квитанция для ПИНФЛ {pinfl_of_debtor} успешно создана")
             return response.json()
@@ -120,71 +170,174 @@ class CreateReceiptAPI(Mixin):
                          extra={"user_message": "Ошибка отправки запроса на создание квитанции"})
             raise CreateReceiptException(f"Статус код не равен 201 при создании квитанции: {response.json()}")
 
-    def _write_to_excel(self, data, filename):
-        try:
-            wb = load_workbook(filename)
-            ws = wb.active
-        except FileNotFoundError:
-            wb = Workbook()
-            ws = wb.active
-            headers = ['ФИО', 'Пинфл должника', 'Номер квитанции', 'Название региона', 'Сумма квитанции', 'Ссылка на квитанцию']
-            ws.append(headers)
+    async def _async_post_create(self, session, body, headers, receipt_id=None, pinfl_of_debtor=None):
+        await self.rate_limiter.async_acquire()
+        if receipt_id is not None:
+            await asyncio.to_thread(self._journal, 'intent', receipt_id, pinfl_of_debtor)
+        async with session.post(f'{self.BASE_URL}/api/invoice/create', json=body, headers=headers,
+                                timeout=120) as response:
+            response.raise_for_status()
+            return response.status, await response.json()
+
+    async def async_request_create_receipt(self, session, court_id, pinfl_of_debtor, name_of_client,
+                                           stir_of_client, address_of_client, sum_of_debt, receipt_id=None):
+        headers = self._get_request_headers()
+        body = self._get_request_body(court_id, name_of_client, stir_of_client, address_of_client, sum_of_debt)
+
+        status, response_data = await async_call_with_retry('create', self._async_post_create, session, body, headers,
+                                                            receipt_id, pinfl_of_debtor)
+        if status == 201:
+            logger.info(f"Квитанция для ПИНФЛ {pinfl_of_debtor} успешно создана")
+            return response_data
+        else:
+            logger.error(f"Статус код не равен 201 при создании квитанции,\nОтвет от сервера: {response_data}",
+                         extra={"user_message": "Ошибка отправки запроса на создание квитанции"})
+            raise CreateReceiptException(f"Статус код не равен 201 при создании квитанции: {response_data}")
 
-        ws.append(data)
-        wb.save(filename)
+    def _created_receipt(self, record, response):
+        invoice = response.get('invoice')
+        return CreatedReceipt(
+            id=record.id,
+            pinfl_of_debtor=record.pinfl_of_debtor,
+            invoice=invoice,
+            sum_of_receipt=record.sum_of_debt,
+            link_of_receipt=f'{self.BASE_URL}/invoice/{invoice}',
+        )
 
     def _create_receipts(self, data_block):
-        for k, v in data_block.items():
+        created = []
+        for record in data_block:
             try:
-                fio = v.get('fio')
-                pinfl_of_debtor = v.get('pinfl_of_debtor')
-                name_of_client = v.get('name_of_client')
-                stir_of_client = v.get('stir_of_client')
-                address_of_client = v.get('address_of_client')
-                sum_of_debt = v.get('sum_of_debt')
-                cort_id = v.get('id_sud')
-                if cort_id:
-                    response = self.request_create_receipt(cort_id, pinfl_of_debtor, name_of_client,
-                                                           stir_of_client, address_of_client, sum_of_debt)
-                    invoice = response.get('invoice')
-                    v['invoice'] = invoice
-                    v['sum_of_receipt'] = sum_of_debt
-                    v['link_of_receipt'] = f'https://***/invoice/{invoice}'
-                    UpdateReceiptsStatus(self.user_id, self.type_of_receipt).update_status_in_db([v])
+                if record.id_sud:
+                    response = self.request_create_receipt(record.id_sud, record.pinfl_of_debtor,
+                                                           record.name_of_client, record.stir_of_client,
+                                                           record.address_of_client, record.sum_of_debt,
+                                                           receipt_id=record.id)
+                    created_receipt = self._created_receipt(record, response)
+                    self._journal('created', created_receipt)
+                    created.append(created_receipt)
+                    metrics.inc('receipts_created_total')
                 else:
-                    logger.error(f'Не удалось получить регион для строки {k} - {v}')
-                    raise CreateReceiptException(f'Не удалось получить регион для строки {k} - {v}')
+                    logger.error(f'Не удалось получить регион для строки {record.id} - {record}')
+                    raise CreateReceiptException(f'Не удалось получить регион для строки {record.id} - {record}')
             except CreateReceiptException as e:
+                self._journal_rejected(record, e)
                 logger.error(f"Ошибка при создании квитанции,\nОшибка: {e}",
-                             extra={"user_message": f'Квитанция для {k} - {v} не создана: {e}'})
+                             extra={"user_message": f'Квитанция для {record.id} - {record} не создана: {e}'})
             except Exception as e:
-                logger.error(f"Ошибка при создании квитанции для {k} - {v},\nОшибка: {e}",
-                             extra={"user_message": f'Что-то пошло не так с {k} - {v}.'})
+                self._journal_rejected(record, e)
+                logger.error(f"Ошибка при создании квитанции для {record.id} - {record},\nОшибка: {e}",
+                             extra={"user_message": f'Что-то пошло не так с {record.id} - {record}.'})
+        self._update_status_in_db(created)
 
-    def process_create_receipts(self):
-        data_for_blocking = self.data
+    def _journal(self, event, *args):
+        if self.journal is not None:
+            getattr(self.journal, event)(*args)
+
+    def _journal_rejected(self, record, e):
+        # Только явный отказ (4xx) гарантирует, что квитанция не создана; после 5xx или ответа 2xx
+        # без 201 она могла быть создана, и intent остается открытым
+        status = get_status(e)
+        if status is not None and 400 <= status < 500:
+            self._journal('failed', record.pinfl_of_debtor)
+
+    def _update_status_in_db(self, data_block):
+        updated = UpdateReceiptsStatus(self.user_id, self.type_of_receipt).update_status_in_db(data_block)
+        for created_receipt in updated:
+            self._journal('committed', created_receipt.pinfl_of_debtor)
+        return updated
+
+    async def _async_create_receipt(self, session, record, created):
+        try:
+            if record.id_sud:
+                response = await self.async_request_create_receipt(session, record.id_sud, record.pinfl_of_debtor,
+                                                                   record.name_of_client, record.stir_of_client,
+                                                                   record.address_of_client, record.sum_of_debt,
+                                                                   receipt_id=record.id)
+                created_receipt = self._created_receipt(record, response)
+                await asyncio.to_thread(self._journal, 'created', created_receipt)
+                created.append(created_receipt)
+                metrics.inc('receipts_created_total')
+                if len(created) >= self.db_batch_size:
+                    await self._async_flush_created(created)
+            else:
+                logger.error(f'Не удалось получить регион для строки {record.id} - {record}')
+                raise CreateReceiptException(f'Не удалось получить регион для строки {record.id} - {record}')
+        except CreateReceiptException as e:
+            await asyncio.to_thread(self._journal_rejected, record, e)
+            logger.error(f"Ошибка при создании квитанции,\nОшибка: {e}",
+                         extra={"user_message": f'Квитанция для {record.id} - {record} не создана: {e}'})
+        except Exception as e:
+            await asyncio.to_thread(self._journal_rejected, record, e)
+            logger.error(f"Ошибка при создании квитанции для {record.id} - {record},\nОшибка: {e}",
+                         extra={"user_message": f'Что-то пошло не так с {record.id} - {record}.'})
+
+    async def _async_create_worker(self, session, records, created):
+        # Общий итератор: каждый воркер берет следующую запись, очередь всех задач заранее не создается
+        for record in records:
+            await self._async_create_receipt(session, record, created)
+
+    async def _async_flush_created(self, created):
+        data_block = created[:]
+        created.clear()
+        updated = await asyncio.to_thread(self._update_status_in_db, data_block)
+        if self.on_committed is not None:
+            await self.on_committed(updated)
+        return updated
 
-        block_size = 10
-        data_blocks = [dict(list(data_for_blocking.items())[i:i + block_size]) for i in
-                       range(0, len(data_for_blocking), block_size)]
+    async def async_process_create_receipts(self):
+        with metrics.timer('stage_seconds', stage='create'):
+            await self._async_process_create_receipts()
 
-        for block in data_blocks:
+    async def _async_process_create_receipts(self):
+        created = []
+        records = iter(self.data)
+        session = await self.get_http_session()
+        await asyncio.gather(
+            *[self._async_create_worker(session, records, created) for _ in range(self.concurrency)]
+        )
+        if created:
+            await self._async_flush_created(created)
+        self.flush_reports()
+
+    def process_create_receipts(self):
+        with metrics.timer('stage_seconds', stage='create'):
+            self._process_create_receipts()
+
+    def _process_create_receipts(self):
+        for block in batched(self.data, 10):
             self._create_receipts(block)
+        self.flush_reports()
 
 
-def run(user_id, type_of_receipt, modal_window):
-    modal_handler = ModalLogHandler()
-    modal_handler.set_modal_window(modal_window)
-    logger.addHandler(modal_handler)
+def run(user_id, type_of_receipt, modal_window, use_async=False, rate=0.5, burst=1, concurrency=5, rate_limiter=None,
+        resolved_pinfls=None):
+    """resolved_pinfls - ПИНФЛ, проверенные оператором вручную после сбоя: по ним квитанции создаются снова."""
+    modal_handler = attach_modal_log_handler(logger, modal_window)
+    SharedHttpClient.enter()
     try:
-        data_for_automation = GetDataDB(user_id, type_of_receipt).get_data_from_db_to_create_receipts()
-        if not data_for_automation:
+        journal = CreationJournal.for_user(Mixin.FOLDER_PATH_BASE, user_id, type_of_receipt)
+        if resolved_pinfls:
+            journal.resolve(resolved_pinfls)
+        in_doubt = journal.recover(UpdateReceiptsStatus(user_id, type_of_receipt))
+
+        records = (
+            record for record in GetDataDB(user_id, type_of_receipt).iter_data_from_db_to_create_receipts()
+            if record.pinfl_of_debtor not in in_doubt
+        )
+        first_record = next(records, None)
+        if first_record is None:
             logger.info('Нет доступных данных для создание квитанций')
             raise EmptyDBDataException()
-        obj_create_receipt_api = CreateReceiptAPI(data=data_for_automation, user_id=user_id, type_of_receipt=type_of_receipt)
-        obj_create_receipt_api.process_create_receipts()
-
-        logger.removeHandler(modal_handler)
+        data_for_automation = chain([first_record], records)
+        obj_create_receipt_api = CreateReceiptAPI(data=data_for_automation, user_id=user_id, type_of_receipt=type_of_receipt,
+                                                  rate=rate, burst=burst, concurrency=concurrency, journal=journal,
+                                                  rate_limiter=rate_limiter)
+        if use_async:
+            obj_create_receipt_api.run_in_loop(obj_create_receipt_api.async_process_create_receipts())
+        else:
+            obj_create_receipt_api.process_create_receipts()
+        journal.compact()
     except Exception as e:
         if isinstance(e, EmptyDBDataException):
             logger.info(f'Обнаружены проблемы с созданием квитанций: {e}')
@@ -193,4 +346,5 @@ def run(user_id, type_of_receipt, modal_window):
                          extra={'user_message': f'Обнаружены проблемы с созданием квитанций'})
         raise CreateReceiptErrorException()
     finally:
-        logger.removeHandler(modal_handler)
+        SharedHttpClient.leave()
+        detach_modal_log_handler(logger, modal_handler)
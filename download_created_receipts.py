@@ -1,21 +1,25 @@
 import asyncio
+import hashlib
+import json
 import logging
+from itertools import islice
 
 import aiofiles
-import aiohttp
 from aiofiles import ospath
 from aiofiles import os as os_aio
 
 import os
-from openpyxl.reader.excel import load_workbook
-from openpyxl.workbook import Workbook
 
 from exceptions.pages_exceptions import DownloadReceiptErrorException
 from exceptions.pages_exceptions import EmptyDBDataException
-from config.modal_log_handler import ModalLogHandler
 from models import PaidStatusEnum
 from .base import GetDataDB, Mixin
 from .base import run_check_paid_receipt
+from .http_client import SharedHttpClient
+from .log_queue import attach_modal_log_handler, detach_modal_log_handler
+from .metrics import metrics
+from .report_writer import ReportWriterMixin
+from .resilience import async_call_with_retry
 from models import StatusSudEnum
 
 logger = logging.getLogger(__name__)
@@ -27,11 +31,59 @@ class DownloadReceiptException(Exception):
         super().__init__(self.message)
 
 
-class DownloadCreatedReceipt(Mixin):
-    def __init__(self, user_id, type_of_receipt, path: str):
+class DownloadManifest:
+    """Сведения о скачанных файлах: invoice -> путь, размер и sha256."""
+    FILE_NAME = '.download_manifest.json'
+
+    def __init__(self, folder_path):
+        self.path = os.path.join(folder_path, self.FILE_NAME)
+        self.entries = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    def is_complete(self, invoice_number, verify_hash=False):
+        entry = self.entries.get(str(invoice_number))
+        if entry is None:
+            return False
+        try:
+            if os.path.getsize(entry['path']) != entry['size']:
+                return False
+        except OSError:
+            return False
+        if verify_hash:
+            sha256 = hashlib.sha256()
+            with open(entry['path'], 'rb') as file:
+                for chunk in iter(lambda: file.read(DownloadCreatedReceipt.CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+            return sha256.hexdigest() == entry['sha256']
+        return True
+
+    def add(self, invoice_number, path, size, sha256):
+        self.entries[str(invoice_number)] = {'path': path, 'size': size, 'sha256': sha256}
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+class DownloadCreatedReceipt(ReportWriterMixin, Mixin):
+    REPORT_HEADERS = ['Пинфл должника', 'ФИО', 'Номер квитанции', 'Название региона', 'Сумма квитанции', 'Ссылка на квитанцию']
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, user_id, type_of_receipt, path: str, verify_hash=False, rate_limiter=None, storage=None):
         self.full_path = path
+        self.storage = storage
+        self.rate_limiter = rate_limiter
         self.user_id = user_id
         self.type_of_receipt = type_of_receipt
+        self.report_writers = {}
+        self.manifest = DownloadManifest(path)
+        self.verify_hash = verify_hash
 
         self.type_name_of_output()
 
@@ -43,20 +95,36 @@ class DownloadCreatedReceipt(Mixin):
             self.name_of_not_created_excel = 'not_created_receipts_info_post.xlsx'
             self.prefix_for_file = 'PR '
 
-    def _write_to_excel(self, data, filename):
-        try:
-            wb = load_workbook(filename)
-            ws = wb.active
-        except FileNotFoundError:
-            wb = Workbook()
-            ws = wb.active
-            headers = ['Пинфл должника', 'ФИО', 'Номер квитанции', 'Название региона', 'Сумма квитанции', 'Ссылка на квитанцию']
-            ws.append(headers)
+    async def _fetch_pdf(self, session, params, headers, full_path):
+        if self.rate_limiter is not None:
+            await self.rate_limiter.async_acquire()
+        async with session.get(f'{self.BASE_URL}/api/invoice/asDocument', params=params,
+                               headers=headers, timeout=120) as response:
+            response.raise_for_status()
+            if response.status == 200:
+                tmp_path = f'{full_path}.part'
+                sha256 = hashlib.sha256()
+                size = 0
+                try:
+                    async with aiofiles.open(tmp_path, 'wb') as f:
+                        async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                            sha256.update(chunk)
+                            size += len(chunk)
+                            await f.write(chunk)
+                    await os_aio.replace(tmp_path, full_path)
+                except BaseException:
+                    if await ospath.exists(tmp_path):
+                        await os_aio.remove(tmp_path)
+                    raise
+                metrics.inc('pdf_downloaded_bytes_total', size)
+                return response.status, size, sha256.hexdigest()
+            return response.status, None, None
 
-        ws.append(data)
-        wb.save(filename)
+    async def _get_download_path(self, invoice_number, filename, pinfl):
+        file_name = f'{self.prefix_for_file} {filename}_{pinfl}_{invoice_number}.pdf'
+        if self.storage is not None:
+            return self.storage.get_tmp_path(invoice_number), os.path.join(filename, file_name)
 
-    async def async_request_download_pdf(self, session, semaphore, invoice_number, filename, pinfl):
         _dir_name = filename
         if not await ospath.isdir(os.path.join(self.full_path, _dir_name)):
             _dir_name = f"auto_create_{filename}"
@@ -65,29 +133,42 @@ class DownloadCreatedReceipt(Mixin):
             except FileExistsError as e:
                 print(f"FILE EXIST == {e}")
 
-        full_path = os.path.join(
-            self.full_path,
-            _dir_name,
-            f'{self.prefix_for_file} {filename}_{pinfl}_{invoice_number}.pdf'
-        )
+        return os.path.join(self.full_path, _dir_name, file_name), None
+
+    async def _is_downloaded(self, invoice_number):
+        if self.storage is not None:
+            return self.storage.has(invoice_number)
+        if self.verify_hash:
+            # Хэширование файла целиком не должно блокировать цикл событий
+            return await asyncio.to_thread(self.manifest.is_complete, invoice_number, True)
+        return self.manifest.is_complete(invoice_number)
+
+    async def async_request_download_pdf(self, session, semaphore, invoice_number, filename, pinfl):
+        if await self._is_downloaded(invoice_number):
+            logger.info(f'Квитанция {invoice_number} уже скачана, пропускаем')
+            return
+
+        full_path, relpath = await self._get_download_path(invoice_number, filename, pinfl)
 
         headers = self.HEADERS.copy()
-        headers['Referer'] = f'https://***/invoice/{invoice_number}'
+        headers['Referer'] = f'{self.BASE_URL}/invoice/{invoice_number}'
 
         params = {"invoice": invoice_number}
         try:
             async with semaphore:
                 logger.info(f'Выполняется запрос для загрузки файла {filename} {invoice_number}')
-                async with session.get('https://***/api/invoice/asDocument', params=params,
-                                       headers=headers, timeout=120) as response:
-                    response.raise_for_status()
-                    if response.status == 200:
-                        async with aiofiles.open(full_path, 'wb') as f:
-                            await f.write(await response.read())
-                        logger.info(f"Квитанция сохранена по пути: {full_path}")
+                status, size, sha256 = await async_call_with_retry('download', self._fetch_pdf, session, params,
+                                                                   headers, full_path)
+                if status == 200:
+                    if self.storage is not None:
+                        await asyncio.to_thread(self.storage.put, invoice_number, full_path, sha256, size, relpath)
+                        full_path = f'{self.storage.root}:{relpath}'
                     else:
-                        logger.error(f"Статус ответа от сервера не равен 200 при загрузке документа {invoice_number},\nСтатус: {response.status}",
-                                     extra={"user_message": f"Ошибка при загрузке файла: {invoice_number}"})
+                        self.manifest.add(invoice_number, full_path, size, sha256)
+                    logger.info(f"Квитанция сохранена по пути: {full_path}")
+                else:
+                    logger.error(f"Статус ответа от сервера не равен 200 при загрузке документа {invoice_number},\nСтатус: {status}",
+                                 extra={"user_message": f"Ошибка при загрузке файла: {invoice_number}"})
         except asyncio.TimeoutError as e:
             logger.error(f'Превышен таймаут при загрузке файла')
         except Exception as e:
@@ -108,23 +189,39 @@ class DownloadCreatedReceipt(Mixin):
                              extra={"user_message": f'Что-то пошло не так с {invoice} - {fio} - {pinfl}.'})
         await asyncio.gather(*tasks)
 
-    async def async_process_for_download_pdf(self, ids):
-        data_for_blocking = GetDataDB(self.user_id, self.type_of_receipt).get_data_from_db_for_download_pdf_today(ids)
+    async def async_process_for_download_pdf(self, ids, rows=None):
+        with metrics.timer('stage_seconds', stage='download'):
+            await self._async_process_for_download_pdf(ids, rows)
+
+    async def _async_process_for_download_pdf(self, ids, rows=None):
+        if rows is None:
+            rows = GetDataDB(self.user_id, self.type_of_receipt).iter_data_from_db_for_download_pdf_today(ids)
+        rows = iter(rows)
 
         block_size = 10
-        data_blocks = [data_for_blocking[i:i + block_size] for i in range(0, len(data_for_blocking), block_size)]
-        async with aiohttp.ClientSession() as session:
-            for block in data_blocks:
+        session = await self.get_http_session()
+        try:
+            while block := list(islice(rows, block_size)):
                 await self._download_pdf(session, block)
+                if self.storage is None:
+                    # После падения скачанные в этом запуске файлы не будут скачиваться повторно
+                    await asyncio.to_thread(self.manifest.save)
+        finally:
+            if self.storage is not None:
+                await asyncio.to_thread(self.storage.close)
+            else:
+                self.manifest.save()
+        self.flush_reports()
 
 
-def run(user_id, type_of_receipt, receipt_path, modal_window, ids):
-    modal_handler = ModalLogHandler()
-    modal_handler.set_modal_window(modal_window)
-    logger.addHandler(modal_handler)
+def run(user_id, type_of_receipt, receipt_path, modal_window, ids, check_before_download=True, rate_limiter=None,
+        storage=None):
+    modal_handler = attach_modal_log_handler(logger, modal_window)
+    SharedHttpClient.enter()
 
     try:
-        run_check_paid_receipt(user_id, type_of_receipt, ids)
+        if check_before_download:
+            run_check_paid_receipt(user_id, type_of_receipt, ids, rate_limiter=rate_limiter)
         data_for_automation = GetDataDB(user_id, type_of_receipt).get_data_from_db_for_download_pdf_today(ids, check=True)
         if not data_for_automation:
             logger.info('Нет доступных квитанций для скачивания.')
@@ -141,11 +238,12 @@ def run(user_id, type_of_receipt, receipt_path, modal_window, ids):
                     f"Квитанция {params[0]}, ФИО - {receipt[0]} не скачана так как {params[1]}."
                 )
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-        obj_create_receipt_api = DownloadCreatedReceipt(user_id, type_of_receipt, receipt_path)
-        loop.run_until_complete(obj_create_receipt_api.async_process_for_download_pdf(ids))
+        obj_create_receipt_api = DownloadCreatedReceipt(user_id, type_of_receipt, receipt_path,
+                                                        rate_limiter=rate_limiter, storage=storage)
+        # Статусы уже прочитаны после проверки, повторный запрос по тем же ids не нужен
+        paid_rows = [(fio, pinfl, invoice) for fio, paid, pinfl, invoice in data_for_automation
+                     if paid == PaidStatusEnum.PAID]
+        obj_create_receipt_api.run_in_loop(obj_create_receipt_api.async_process_for_download_pdf(ids, paid_rows))
     except Exception as e:
         if isinstance(e, EmptyDBDataException):
             logger.info(f'Обнаружены проблемы со скачиванием квитанций: {e}')
@@ -154,5 +252,6 @@ def run(user_id, type_of_receipt, receipt_path, modal_window, ids):
                          extra={'user_message': f'Обнаружены проблемы со скачиванием квитанций'})
         raise e
     finally:
-        logger.removeHandler(modal_handler)
+        SharedHttpClient.leave()
+        detach_modal_log_handler(logger, modal_handler)
 
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import threading
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class SharedHttpClient:
+    """Общий event loop и пул соединений для всех этапов (создание, проверка, скачивание).
+
+    Loop и сессии свои у каждого потока, чтобы этапы могли выполняться параллельно в пуле потоков.
+    Точки входа оборачиваются в enter()/leave(): клиент закрывается, когда поток выходит из самой внешней.
+    """
+    LIMIT = 100
+    LIMIT_PER_HOST = 20
+    KEEPALIVE_TIMEOUT = 60
+    DNS_CACHE_TTL = 300
+    TRACE_CONFIGS = []
+
+    _local = threading.local()
+
+    @classmethod
+    def get_loop(cls):
+        loop = getattr(cls._local, 'loop', None)
+        if loop is None or loop.is_closed():
+            loop = cls._local.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+    @classmethod
+    def run(cls, coro):
+        return cls.get_loop().run_until_complete(coro)
+
+    @classmethod
+    async def get_session(cls):
+        session = getattr(cls._local, 'session', None)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=cls.LIMIT,
+                limit_per_host=cls.LIMIT_PER_HOST,
+                keepalive_timeout=cls.KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=cls.DNS_CACHE_TTL,
+            )
+            session = cls._local.session = aiohttp.ClientSession(connector=connector,
+                                                                 trace_configs=cls.TRACE_CONFIGS)
+        return session
+
+    @classmethod
+    def get_requests_session(cls):
+        session = getattr(cls._local, 'requests_session', None)
+        if session is None:
+            session = cls._local.requests_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cls.LIMIT_PER_HOST)
+            session.mount('https://', adapter)
+        return session
+
+    @classmethod
+    def enter(cls):
+        cls._local.depth = getattr(cls._local, 'depth', 0) + 1
+
+    @classmethod
+    def leave(cls):
+        cls._local.depth = getattr(cls._local, 'depth', 1) - 1
+        if cls._local.depth <= 0:
+            cls._local.depth = 0
+            cls.close()
+
+    @classmethod
+    def close(cls):
+        session = getattr(cls._local, 'session', None)
+        if session is not None and not session.closed:
+            cls.run(session.close())
+        cls._local.session = None
+        requests_session = getattr(cls._local, 'requests_session', None)
+        if requests_session is not None:
+            requests_session.close()
+            cls._local.requests_session = None
+        loop = getattr(cls._local, 'loop', None)
+        if loop is not None and not loop.is_closed():
+            loop.close()
+        cls._local.loop = None
@@ -0,0 +1,86 @@
+import logging
+
+from sqlalchemy import Index, func, inspect, select, text
+
+from models import Receipt, PaidStatusEnum, StatusSudEnum
+
+logger = logging.getLogger(__name__)
+
+_created_filter = (Receipt.status_of_created == False) & (Receipt.paid == PaidStatusEnum.NOT_CREATED)
+_check_filter = Receipt.paid.in_([PaidStatusEnum.CHECKING, PaidStatusEnum.CREATED])
+# Колонка расписания фонового поллера появляется в models вместе со своей миграцией
+_check_columns = [Receipt.user_id, Receipt.type_of_sud]
+if hasattr(Receipt, 'next_check_at'):
+    _check_columns.append(Receipt.next_check_at)
+
+RECEIPT_INDEXES = [
+    # Загрузка борда и запись статуса после создания
+    Index('uq_receipt_user_type_pinfl', Receipt.user_id, Receipt.type_of_sud, Receipt.pinfl_of_debtor, unique=True),
+    # Выбор квитанций для создания
+    Index('ix_receipt_to_create', Receipt.user_id, Receipt.type_of_sud,
+          postgresql_where=_created_filter, sqlite_where=_created_filter),
+    # Проверка оплаты и расписание фоновой проверки
+    Index('ix_receipt_to_check', *_check_columns,
+          postgresql_where=_check_filter, sqlite_where=_check_filter),
+]
+
+HOT_QUERIES = {
+    'load': lambda: select(Receipt.id).where(
+        Receipt.user_id == 1, Receipt.type_of_sud == StatusSudEnum.CIVIL, Receipt.pinfl_of_debtor == '0' * 14),
+    'create': lambda: select(Receipt.id).where(
+        Receipt.user_id == 1, Receipt.type_of_sud == StatusSudEnum.CIVIL, _created_filter),
+    'check': lambda: select(Receipt.id).where(
+        Receipt.user_id == 1, Receipt.type_of_sud == StatusSudEnum.CIVIL, _check_filter),
+    'download': lambda: select(Receipt.id).where(
+        Receipt.user_id == 1, Receipt.type_of_sud == StatusSudEnum.CIVIL, Receipt.id.in_([1, 2, 3]),
+        Receipt.paid == PaidStatusEnum.PAID),
+}
+
+
+def find_duplicate_receipts(connection):
+    """Дубликаты (user_id, type_of_sud, pinfl_of_debtor), из-за которых не создастся уникальный индекс."""
+    return connection.execute(
+        select(Receipt.user_id, Receipt.type_of_sud, Receipt.pinfl_of_debtor, func.count())
+        .group_by(Receipt.user_id, Receipt.type_of_sud, Receipt.pinfl_of_debtor)
+        .having(func.count() > 1)
+    ).all()
+
+
+def create_receipt_indexes(engine):
+    """Миграция: создает недостающие индексы Receipt. Повторный запуск ничего не меняет."""
+    with engine.begin() as connection:
+        existing = {index['name'] for index in inspect(connection).get_indexes(Receipt.__tablename__)}
+        for index in RECEIPT_INDEXES:
+            if index.name in existing:
+                continue
+            if index.unique:
+                duplicates = find_duplicate_receipts(connection)
+                if duplicates:
+                    logger.error(f'Индекс {index.name} не создан, найдено дубликатов: {len(duplicates)}',
+                                 extra={"user_message": "В БД есть повторяющиеся квитанции по ПИНФЛ"})
+                    continue
+            index.create(connection)
+            logger.info(f'Создан индекс {index.name}')
+
+
+def explain(connection, query):
+    compiled = query.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})
+    if connection.dialect.name == 'sqlite':
+        return '\n'.join(row[-1] for row in connection.execute(text(f'EXPLAIN QUERY PLAN {compiled}')))
+    return '\n'.join(row[0] for row in connection.execute(text(f'EXPLAIN {compiled}')))
+
+
+def check_query_plans(engine):
+    """Проверяет, что фильтры всех этапов идут по индексам; возвращает {запрос: план} для отклонившихся."""
+    problems = {}
+    with engine.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            # На маленьких таблицах планировщик всегда выбирает seq scan
+            connection.execute(text('SET enable_seqscan = off'))
+        for name, make_query in HOT_QUERIES.items():
+            plan = explain(connection, make_query())
+            if 'Seq Scan' in plan or any(line.startswith('SCAN') and 'INDEX' not in line
+                                         for line in plan.splitlines()):
+                problems[name] = plan
+        connection.rollback()
+    return problems
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import threading
+
+from database import Session
+from models import Receipt
+from .base import ID_CHUNK_SIZE, CreatedReceipt, batched
+
+logger = logging.getLogger(__name__)
+
+INTENT = 'intent'
+CREATED = 'created'
+COMMITTED = 'committed'
+FAILED = 'failed'
+
+
+class CreationJournal:
+    """Журнал создания квитанций (intent -> created -> committed), одна json-запись на строку.
+
+    Каждая запись сбрасывается на диск до продолжения работы, поэтому после падения
+    по журналу видно, какие квитанции API уже создал, но в БД они не записаны.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.states = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def for_user(cls, folder_path, user_id, type_of_receipt):
+        type_name = getattr(type_of_receipt, 'name', type_of_receipt)
+        return cls(os.path.join(folder_path, f'creation_journal_{user_id}_{type_name}.jsonl'))
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Последняя строка могла быть записана не полностью
+                    continue
+                state = self.states.setdefault(record['pinfl_of_debtor'], {})
+                state.update(record)
+
+    def _write(self, record):
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self.states.setdefault(record['pinfl_of_debtor'], {}).update(record)
+
+    def intent(self, receipt_id, pinfl_of_debtor):
+        self._write({'event': INTENT, 'id': receipt_id, 'pinfl_of_debtor': pinfl_of_debtor})
+
+    def created(self, created_receipt):
+        self._write({'event': CREATED, **created_receipt._asdict()})
+
+    def committed(self, pinfl_of_debtor):
+        self._write({'event': COMMITTED, 'pinfl_of_debtor': pinfl_of_debtor})
+
+    def failed(self, pinfl_of_debtor):
+        """Сервер явно отклонил запрос - квитанция не создана и ее можно создавать повторно."""
+        self._write({'event': FAILED, 'pinfl_of_debtor': pinfl_of_debtor})
+
+    def get_in_doubt(self, event):
+        return {pinfl: state for pinfl, state in self.states.items() if state['event'] == event}
+
+    def _get_committed_in_db(self, states):
+        """ПИНФЛ записей журнала, у которых в БД уже стоит status_of_created."""
+        pinfls = set()
+        session = Session()
+        try:
+            for ids_chunk in batched(sorted(int(state['id']) for state in states.values()), ID_CHUNK_SIZE):
+                rows = session.query(Receipt.pinfl_of_debtor).filter(
+                    Receipt.id.in_(ids_chunk),
+                    Receipt.status_of_created == True,
+                ).all()
+                pinfls.update(pinfl_of_debtor for (pinfl_of_debtor,) in rows)
+        finally:
+            session.close()
+        return pinfls
+
+    def recover(self, updater):
+        """Дописывает в БД созданные, но не записанные квитанции; возвращает ПИНФЛ, по которым статус неизвестен."""
+        created = self.get_in_doubt(CREATED)
+        # Сбой мог случиться после коммита в БД, но до записи committed в журнал
+        for pinfl_of_debtor in self._get_committed_in_db(created) if created else ():
+            self.committed(pinfl_of_debtor)
+            created.pop(pinfl_of_debtor, None)
+        if created:
+            logger.info(f'Восстановление после сбоя: {len(created)} созданных квитанций не записаны в БД')
+            data_block = [
+                CreatedReceipt(*(state[field] for field in CreatedReceipt._fields)) for state in created.values()
+            ]
+            for created_receipt in updater.update_status_in_db(data_block):
+                self.committed(created_receipt.pinfl_of_debtor)
+                created.pop(created_receipt.pinfl_of_debtor, None)
+
+        intents = self.get_in_doubt(INTENT)
+        for pinfl_of_debtor in self._get_committed_in_db(intents) if intents else ():
+            self.committed(pinfl_of_debtor)
+            intents.pop(pinfl_of_debtor, None)
+
+        for pinfl_of_debtor in intents:
+            logger.error(f'Квитанция для ПИНФЛ {pinfl_of_debtor} могла быть создана до сбоя, повторно не создается',
+                         extra={"user_message": f'Проверьте вручную квитанцию для ПИНФЛ {pinfl_of_debtor}'})
+        for pinfl_of_debtor, state in created.items():
+            logger.error(f"Квитанция {state['invoice']} для ПИНФЛ {pinfl_of_debtor} создана, но не записана в БД",
+                         extra={"user_message": f'Проверьте вручную квитанцию для ПИНФЛ {pinfl_of_debtor}'})
+        return set(intents) | set(created)
+
+    def resolve(self, pinfls):
+        """Снимает отметку "в сомнении" после ручной проверки.
+
+        Квитанция без ответа биллинга (intent) снова будет создаваться; созданная (created) закрывается без повтора.
+        """
+        for pinfl_of_debtor in pinfls:
+            event = self.states.get(pinfl_of_debtor, {}).get('event')
+            if event == INTENT:
+                self.failed(pinfl_of_debtor)
+            elif event == CREATED:
+                self.committed(pinfl_of_debtor)
+
+    def compact(self):
+        """Удаляет журнал, если все записи завершены."""
+        with self._lock:
+            if all(state['event'] in (COMMITTED, FAILED) for state in self.states.values()) and os.path.exists(self.path):
+                os.remove(self.path)
+                self.states.clear()
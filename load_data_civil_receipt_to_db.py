@@ -1,85 +1,163 @@
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
 
+import numpy as np
 import pandas as pd
+from openpyxl import load_workbook
 from database import Session
-from models import Receipt, PaidStatusEnum
+from models import Receipt, PaidStatusEnum, StatusSudEnum
+from sqlalchemy import insert, update
 from sqlalchemy.exc import SQLAlchemyError
-from models import Receipt
 
 from validators.excel_validators import validate_receipt
 
-from config.modal_log_handler import ModalLogHandler
+from .base import ID_CHUNK_SIZE, batched
+from .log_queue import attach_modal_log_handler, detach_modal_log_handler
+from .metrics import metrics
 
 logger = logging.getLogger(__name__)
 
 
-def parse_excel_data_civil_receipts(file_path, user_id, type_of_receipt, modal_window):
+PERCENT_OF_FEE = 4
+MIN_FEE = 375000
+
+
+def log_rejection(field, rows, file_name=None):
+    source = f'Файл {file_name}: ' if file_name else ''
+    logger.error(f"{source}Некорректное поле '{field}' в строках: {rows}",
+                 extra={"user_message": f"{source}Строки с некорректным полем '{field}' не загружены: {rows}"})
+
+
+def prepare_receipts_frame(df, type_of_receipt, rejections=None):
+    """Проверяет строки борда и считает сумму квитанции сразу для всей таблицы.
+
+    Возвращает (строки, суммы квитанций); строки с ошибками отбрасываются до начала транзакции.
+    Если передан список rejections, ошибки (поле, строки) добавляются в него, а не в лог.
+    """
+    df = df.dropna(how='all')
+    id_sud = df.iloc[:, 2]
+    stir = df.iloc[:, 4].astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+    sum_of_debt = pd.to_numeric(df.iloc[:, 6], errors='coerce')
+    pinfl = df.iloc[:, 7].astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+
+    errors = pd.DataFrame({
+        'ПИНФЛ': ~pinfl.str.fullmatch(r'\d{14}'),
+        'СТИР': ~stir.str.fullmatch(r'\d{9}'),
+        'ID суда': id_sud.isna(),
+        'сумма долга': sum_of_debt.isna(),
+    }, index=df.index)
+    invalid = errors.any(axis=1)
+    if invalid.any():
+        for field, mask in errors.items():
+            if mask.any():
+                rows = ', '.join(str(idx + 2) for idx in df.index[mask])
+                if rejections is None:
+                    log_rejection(field, rows)
+                else:
+                    rejections.append((field, rows))
+
+    valid = ~invalid
+    if type_of_receipt == StatusSudEnum.CIVIL:
+        amounts = np.maximum(sum_of_debt[valid].to_numpy() * (PERCENT_OF_FEE / 100), MIN_FEE)
+    else:
+        amounts = sum_of_debt[valid].to_numpy()
+
+    df = df[valid].astype(object)
+    df.iloc[:, 7] = pinfl[valid].to_numpy()
+    return df.values.tolist(), amounts.tolist()
+
+
+def _get_row_values(row):
+    return {
+        'name_of_region': row[1],
+        'id_sud': row[2],
+        'name_of_client': row[3],
+        'stir_of_client': row[4],
+        'fio': row[5],
+        'sum_of_debt': row[6],
+        'address_of_client': row[9],
+        'status_of_created': False,
+        'paid': PaidStatusEnum.NOT_CREATED,
+    }
+
+
+def bulk_upsert_receipts(session, rows_list, amounts, user_id, type_of_receipt):
+    # Блокируются только строки с ПИНФЛ из борда, а не вся история пользователя
+    filter_list = [
+        Receipt.type_of_sud == type_of_receipt,
+        Receipt.user_id == user_id,
+    ]
+    existing = []
     try:
-        modal_handler = ModalLogHandler()
-        modal_handler.set_modal_window(modal_window)
-        logger.addHandler(modal_handler)
+        for pinfls_chunk in batched(sorted({str(row[7]) for row in rows_list}), ID_CHUNK_SIZE):
+            existing.extend(session.query(
+                Receipt.id, Receipt.pinfl_of_debtor, Receipt.paid, Receipt.status_of_created, Receipt.number_of_receipt
+            ).filter(*filter_list, Receipt.pinfl_of_debtor.in_(pinfls_chunk)).with_for_update().all())
+    except SQLAlchemyError as e:
+        logger.error(f"Ошибка запроса в БД: {e}",
+                     extra={"user_message": f"Ошибка загрузки данных в БД"})
+        raise e
+    existing_by_pinfl = {row.pinfl_of_debtor: row for row in existing}
+
+    inserts = {}
+    updates = {}
+    paid_numbers = []
+    created_numbers = []
+    for row, sum_of_receipt in zip(rows_list, amounts):
+        pinfl_of_debtor = str(row[7])
+        existing_receipt = existing_by_pinfl.get(pinfl_of_debtor)
+        values = _get_row_values(row)
+        values['sum_of_receipt'] = sum_of_receipt
+
+        if existing_receipt is None:
+            values.update(pinfl_of_debtor=pinfl_of_debtor, type_of_sud=type_of_receipt, user_id=user_id)
+            inserts[pinfl_of_debtor] = values
+        elif existing_receipt.paid == PaidStatusEnum.PAID:
+            paid_numbers.append(existing_receipt.number_of_receipt)
+        elif existing_receipt.status_of_created and existing_receipt.paid == PaidStatusEnum.CREATED:
+            created_numbers.append(existing_receipt.number_of_receipt)
+        else:
+            values['id'] = existing_receipt.id
+            updates[existing_receipt.id] = values
 
+    with metrics.timer('db_commit_seconds', operation='load_upsert'):
+        if inserts:
+            session.execute(insert(Receipt), list(inserts.values()))
+        if updates:
+            session.execute(update(Receipt), list(updates.values()))
+    metrics.inc('receipts_loaded_total', len(inserts) + len(updates))
+
+    if paid_numbers:
+        logger.info(f"Квитанции уже оплачены ({len(paid_numbers)}): № {', '.join(map(str, paid_numbers))}")
+    if created_numbers:
+        logger.info(f"Квитанции уже созданы но еще не оплачены ({len(created_numbers)}): "
+                    f"№ {', '.join(map(str, created_numbers))}")
+    logger.info(f"Добавлено: {len(inserts)}, обновлено: {len(updates)}, "
+                f"пропущено: {len(paid_numbers) + len(created_numbers)}")
+    return {'inserted': len(inserts), 'updated': len(updates), 'skipped': len(paid_numbers) + len(created_numbers)}
+
+
+def parse_excel_data_civil_receipts(file_path, user_id, type_of_receipt, modal_window):
+    modal_handler = attach_modal_log_handler(logger, modal_window)
+    try:
         df = pd.read_excel(file_path, sheet_name='Основной борд', header=0)
 
         validate_receipt(df)
 
-        rows_list = df.values.tolist()
+        rows_list, amounts = prepare_receipts_frame(df, type_of_receipt)
     except Exception as e:
         logger.error(f"Ошибка во время чтения эксель файла: {e}",
                      extra={"user_message": f"Ошибка при чтения эксель файла"})
+        detach_modal_log_handler(logger, modal_handler)
         raise e
 
     error = None
     session = Session()
     try:
-        with (session.begin()):
-            for idx, row in enumerate(rows_list):
-                sum_of_debt = row[6]
-                try:
-                    existing_receipt = session.query(Receipt).filter(Receipt.pinfl_of_debtor == str(row[7]),
-                                                                     Receipt.type_of_sud == type_of_receipt,
-                                                                     Receipt.user_id == user_id,
-                                                                     ).with_for_update().first()
-                except SQLAlchemyError as e:
-                    logger.error(f"Ошибка запроса в БД: {e}",
-                                 extra={"user_message": f"Ошибка загрузки данных в БД"})
-                    session.rollback()
-                    raise e
-
-                if existing_receipt:
-                    if existing_receipt.paid == PaidStatusEnum.PAID:
-                        logger.info(f"Квитанция № {existing_receipt.number_of_receipt} уже оплачена")
-                        continue
-                    elif existing_receipt.status_of_created and existing_receipt.paid == PaidStatusEnum.CREATED:
-                        logger.info(f"Квитанция № {existing_receipt.number_of_receipt} уже создана но еще не оплачена")
-                        continue
-                    else:
-                        existing_receipt.name_of_region = row[1]
-                        existing_receipt.id_sud = row[2]
-                        existing_receipt.name_of_client = row[3]
-                        existing_receipt.stir_of_client = row[4]
-                        existing_receipt.fio = row[5]
-                        existing_receipt.sum_of_debt = sum_of_debt
-                        existing_receipt.address_of_client = row[9]
-                        existing_receipt.status_of_created = False
-                        existing_receipt.paid = PaidStatusEnum.NOT_CREATED
-                else:
-                    receipt_civil = Receipt(
-                        name_of_region=row[1],
-                        id_sud=row[2],
-                        name_of_client=row[3],
-                        stir_of_client=row[4],
-                        fio=row[5],
-                        sum_of_debt=sum_of_debt,
-                        pinfl_of_debtor=str(row[7]),
-                        address_of_client=row[9],
-                        type_of_sud=type_of_receipt,
-                        status_of_created=False,
-                        paid=PaidStatusEnum.NOT_CREATED,
-                        user_id=user_id
-                    )
-                    session.add(receipt_civil)
-        session.commit()
+        with (session.begin()), metrics.timer('stage_seconds', stage='load'):
+            bulk_upsert_receipts(session, rows_list, amounts, user_id, type_of_receipt)
         logger.info("Данные успешно загружены в БД")
     except SQLAlchemyError as e:
         logger.error(f"Ошибка сохранения данных в БД,\nОшибка: {e}",
@@ -87,7 +165,115 @@ def parse_excel_data_civil_receipts(file_path, user_id, type_of_receipt, modal_w
         session.rollback()
         error = e
     finally:
-        logger.removeHandler(modal_handler)
+        detach_modal_log_handler(logger, modal_handler)
         session.close()
         if error is not None:
             raise error
+
+
+def iter_excel_chunks(file_path, chunk_size=1000):
+    wb = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = wb['Основной борд'].iter_rows(values_only=True)
+        columns = next(rows, None)
+        if columns is None:
+            return
+        start = 0
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            yield pd.DataFrame(chunk, columns=columns, index=range(start, start + len(chunk)))
+            start += len(chunk)
+    finally:
+        wb.close()
+
+
+def stream_excel_data_civil_receipts(file_path, user_id, type_of_receipt, modal_window, chunk_size=1000):
+    """Загрузка борда частями по chunk_size строк, каждая часть коммитится отдельно."""
+    modal_handler = attach_modal_log_handler(logger, modal_window)
+
+    loaded = 0
+    try:
+        for df in iter_excel_chunks(file_path, chunk_size):
+            df = df.dropna(how='all')
+            if df.empty:
+                continue
+            try:
+                validate_receipt(df)
+            except Exception as e:
+                logger.error(f"Ошибка во время чтения эксель файла: {e}",
+                             extra={"user_message": f"Ошибка при чтения эксель файла"})
+                raise e
+
+            rows_list, amounts = prepare_receipts_frame(df, type_of_receipt)
+            if not rows_list:
+                continue
+
+            session = Session()
+            try:
+                with session.begin():
+                    bulk_upsert_receipts(session, rows_list, amounts, user_id, type_of_receipt)
+            except SQLAlchemyError as e:
+                logger.error(f"Ошибка сохранения данных в БД после {loaded} строк,\nОшибка: {e}",
+                             extra={"user_message": f"Ошибка загрузки данных в БД"})
+                raise e
+            finally:
+                session.close()
+            loaded += len(rows_list)
+        logger.info(f"Данные успешно загружены в БД, строк: {loaded}")
+    finally:
+        detach_modal_log_handler(logger, modal_handler)
+
+
+def parse_excel_file(file_path, type_of_receipt):
+    """Чтение и проверка одного борда; выполняется в отдельном процессе.
+
+    Лог процесса до модального окна не доходит, поэтому ошибки строк возвращаются вызывающему.
+    """
+    df = pd.read_excel(file_path, sheet_name='Основной борд', header=0)
+    validate_receipt(df)
+    rejections = []
+    rows_list, amounts = prepare_receipts_frame(df, type_of_receipt, rejections)
+    return rows_list, amounts, len(df.dropna(how='all')), rejections
+
+
+def ingest_folder(folder_path, user_id, type_of_receipt, modal_window, workers=None):
+    """Параллельный разбор всех бордов папки в пуле процессов, запись в БД одним писателем по файлу за транзакцию."""
+    modal_handler = attach_modal_log_handler(logger, modal_window)
+    results = {}
+    try:
+        file_paths = [
+            os.path.join(folder_path, file_name) for file_name in sorted(os.listdir(folder_path))
+            if file_name.endswith(('.xlsx', '.xls')) and not file_name.startswith('~$')
+        ]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(parse_excel_file, file_path, type_of_receipt): file_path
+                       for file_path in file_paths}
+            for future in as_completed(futures):
+                file_name = os.path.basename(futures[future])
+                try:
+                    rows_list, amounts, total, rejections = future.result()
+                except Exception as e:
+                    logger.error(f"Ошибка во время чтения эксель файла {file_name}: {e}",
+                                 extra={"user_message": f"Ошибка при чтения эксель файла {file_name}"})
+                    results[file_name] = {'status': 'error', 'error': str(e)}
+                    continue
+                for field, rows in rejections:
+                    log_rejection(field, rows, file_name)
+
+                session = Session()
+                try:
+                    with session.begin(), metrics.timer('stage_seconds', stage='load'):
+                        counts = bulk_upsert_receipts(session, rows_list, amounts, user_id, type_of_receipt)
+                    results[file_name] = {'status': 'ok', 'rejected': total - len(rows_list), **counts}
+                    logger.info(f"Файл {file_name} загружен в БД")
+                except SQLAlchemyError as e:
+                    logger.error(f"Ошибка сохранения данных файла {file_name} в БД,\nОшибка: {e}",
+                                 extra={"user_message": f"Ошибка загрузки данных файла {file_name} в БД"})
+                    results[file_name] = {'status': 'error', 'error': str(e)}
+                finally:
+                    session.close()
+    finally:
+        detach_modal_log_handler(logger, modal_handler)
+    return results
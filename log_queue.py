@@ -0,0 +1,99 @@
+import logging
+import queue
+import threading
+import time
+from itertools import groupby
+from logging.handlers import QueueHandler
+
+from config.modal_log_handler import ModalLogHandler
+
+_STOP = object()
+
+
+class BatchingModalListener(threading.Thread):
+    """Забирает записи из очереди и передает их в модальное окно пачками, не чаще одного раза в flush_interval."""
+
+    def __init__(self, log_queue, handler, max_batch=100, flush_interval=0.2):
+        super().__init__(name='modal-log-listener', daemon=True)
+        self.log_queue = log_queue
+        self.handler = handler
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+
+    @staticmethod
+    def _merge(records):
+        """Склеивает записи одного уровня в одну, чтобы окно обновлялось один раз на пачку."""
+        if len(records) == 1:
+            return records[0]
+        record = logging.makeLogRecord(records[-1].__dict__)
+        record.msg = '\n'.join(item.getMessage() for item in records)
+        record.args = None
+        user_messages = [item.user_message for item in records if getattr(item, 'user_message', None)]
+        if user_messages:
+            record.user_message = '\n'.join(user_messages)
+        return record
+
+    def _deliver(self, batch):
+        for _, group in groupby(batch, key=lambda item: item.levelno):
+            record = self._merge(list(group))
+            try:
+                self.handler.handle(record)
+            except Exception:
+                self.handler.handleError(record)
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            record = self.log_queue.get()
+            if record is _STOP:
+                break
+            batch = [record]
+            while len(batch) < self.max_batch:
+                try:
+                    record = self.log_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stopped = True
+                    break
+                batch.append(record)
+            self._deliver(batch)
+            if not stopped:
+                time.sleep(self.flush_interval)
+
+    def stop(self):
+        self.log_queue.put(_STOP)
+        self.join()
+
+
+class ModalQueueHandler(QueueHandler):
+    def __init__(self, log_queue, listener):
+        super().__init__(log_queue)
+        self.listener = listener
+        self.owner = threading.current_thread()
+
+
+def attach_modal_log_handler(logger, modal_window, max_batch=100, flush_interval=0.2):
+    """Подключает модальное окно к логгеру через очередь: в рабочем коде запись лога только кладется в очередь."""
+    current_thread = threading.current_thread()
+    for handler in list(logger.handlers):
+        # Обработчики, оставшиеся от прошлого запуска в этом или уже завершенном потоке
+        if isinstance(handler, ModalQueueHandler) and (handler.owner is current_thread or not handler.owner.is_alive()):
+            detach_modal_log_handler(logger, handler)
+
+    modal_handler = ModalLogHandler()
+    modal_handler.set_modal_window(modal_window)
+    log_queue = queue.SimpleQueue()
+    listener = BatchingModalListener(log_queue, modal_handler, max_batch=max_batch, flush_interval=flush_interval)
+    queue_handler = ModalQueueHandler(log_queue, listener)
+    listener.start()
+    logger.addHandler(queue_handler)
+    return queue_handler
+
+
+def detach_modal_log_handler(logger, queue_handler):
+    if queue_handler not in logger.handlers:
+        return
+    logger.removeHandler(queue_handler)
+    queue_handler.listener.stop()
+    queue_handler.listener.handler.close()
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import tarfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ArchivePdfStorage:
+    """Хранилище pdf по sha256 содержимого в дописываемых tar архивах.
+
+    Одинаковые файлы хранятся один раз. index.jsonl связывает номер квитанции с хэшем и хэш со
+    смещением данных в архиве; export() восстанавливает привычную структуру папок.
+    """
+    INDEX_FILE_NAME = 'index.jsonl'
+
+    def __init__(self, root, archive_max_bytes=1024 ** 3):
+        self.root = root
+        self.archive_max_bytes = archive_max_bytes
+        self.blobs = {}
+        self.invoices = {}
+        self._tar = None
+        self._archive_name = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'tmp'), exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        path = os.path.join(self.root, self.INDEX_FILE_NAME)
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'archive' in record:
+                    self.blobs[record['sha256']] = record
+                else:
+                    self.invoices[record['invoice']] = record
+
+    def _append_index(self, record):
+        with open(os.path.join(self.root, self.INDEX_FILE_NAME), 'a', encoding='utf-8') as file:
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def _next_archive_name(self):
+        numbers = [int(name[len('receipts_'):-len('.tar')]) for name in os.listdir(self.root)
+                   if name.startswith('receipts_') and name.endswith('.tar')]
+        return f'receipts_{max(numbers, default=0) + 1:05d}.tar'
+
+    def _get_tar(self):
+        if self._tar is not None and self._tar.fileobj.tell() < self.archive_max_bytes:
+            return self._tar
+        if self._tar is not None:
+            self._tar.close()
+        # Существующие архивы не дописываются: после сбоя в них нет конца архива и tarfile не откроет их на запись
+        self._archive_name = self._next_archive_name()
+        self._tar = tarfile.open(os.path.join(self.root, self._archive_name), 'x')
+        return self._tar
+
+    def get_tmp_path(self, invoice):
+        return os.path.join(self.root, 'tmp', f'{invoice}.pdf')
+
+    def has(self, invoice):
+        record = self.invoices.get(str(invoice))
+        return record is not None and record['sha256'] in self.blobs
+
+    def put(self, invoice, tmp_path, sha256, size, relpath):
+        with self._lock:
+            if sha256 not in self.blobs:
+                tar = self._get_tar()
+                info = tarfile.TarInfo(f'{sha256}.pdf')
+                info.size = size
+                offset = tar.offset + len(info.tobuf(tar.format, tar.encoding, tar.errors))
+                with open(tmp_path, 'rb') as file:
+                    tar.addfile(info, file)
+                tar.fileobj.flush()
+                os.fsync(tar.fileobj.fileno())
+                blob = {'sha256': sha256, 'archive': self._archive_name, 'offset': offset, 'size': size}
+                self.blobs[sha256] = blob
+                self._append_index(blob)
+            record = {'invoice': str(invoice), 'sha256': sha256, 'relpath': relpath}
+            self.invoices[record['invoice']] = record
+            self._append_index(record)
+        os.remove(tmp_path)
+
+    def open_blob(self, sha256):
+        blob = self.blobs[sha256]
+        file = open(os.path.join(self.root, blob['archive']), 'rb')
+        file.seek(blob['offset'])
+        return file, blob['size']
+
+    def export(self, target_dir, invoices=None):
+        """Выгружает квитанции в target_dir в прежнем виде: <ФИО>/<префикс> <ФИО>_<ПИНФЛ>_<номер>.pdf."""
+        self.flush()
+        invoices = self.invoices if invoices is None else [str(invoice) for invoice in invoices]
+        exported = 0
+        for invoice in invoices:
+            record = self.invoices.get(invoice)
+            if record is None:
+                logger.error(f'Квитанция {invoice} отсутствует в хранилище')
+                continue
+            path = os.path.join(target_dir, record['relpath'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file, size = self.open_blob(record['sha256'])
+            with file, open(path, 'wb') as target:
+                while size > 0:
+                    chunk = file.read(min(size, 1024 * 1024))
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    size -= len(chunk)
+            exported += 1
+        return exported
+
+    def flush(self):
+        with self._lock:
+            if self._tar is not None:
+                self._tar.fileobj.flush()
+
+    def close(self):
+        with self._lock:
+            if self._tar is not None:
+                self._tar.close()
+                self._tar = None
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+
+from validators.excel_validators import validate_receipt
+
+from database import Session
+from .base import CheckPaidReceipt, GetDataDB, Mixin
+from .creation_post_receipts_civil import CreateReceiptAPI, UpdateReceiptsStatus
+from .download_created_receipts import DownloadCreatedReceipt
+from .http_client import SharedHttpClient
+from .journal import CreationJournal
+from .load_data_civil_receipt_to_db import bulk_upsert_receipts, iter_excel_chunks, prepare_receipts_frame
+from .log_queue import attach_modal_log_handler, detach_modal_log_handler
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ReceiptPipeline:
+    """Загрузка -> создание -> проверка оплаты -> скачивание, этапы связаны ограниченными очередями.
+
+    Строки борда попадают на создание сразу после записи своей части в БД, созданные квитанции - на
+    проверку, оплаченные - на скачивание. У каждого этапа свое число воркеров; заполненная очередь
+    притормаживает предыдущий этап. Неоплаченная квитанция возвращается в очередь проверки через
+    recheck_delay секунд и не занимает воркер на время ожидания.
+    """
+
+    def __init__(self, user_id, type_of_receipt, file_path, receipt_path, chunk_size=500, queue_size=200,
+                 create_workers=5, check_workers=20, download_workers=10, rate=0.5, burst=1,
+                 max_checks=3, recheck_delay=30, rate_limiter=None, resolved_pinfls=None):
+        self.user_id = user_id
+        self.type_of_receipt = type_of_receipt
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.create_workers = create_workers
+        self.check_workers = check_workers
+        self.download_workers = download_workers
+        self.max_checks = max_checks
+        self.recheck_delay = recheck_delay
+        self.resolved_pinfls = resolved_pinfls
+
+        self.journal = CreationJournal.for_user(Mixin.FOLDER_PATH_BASE, user_id, type_of_receipt)
+        self.in_doubt = set()
+        self.creator = CreateReceiptAPI(data=None, user_id=user_id, type_of_receipt=type_of_receipt, rate=rate,
+                                        burst=burst, journal=self.journal, rate_limiter=rate_limiter)
+        self.creator.db_batch_size = 10
+        self.checker = CheckPaidReceipt(user_id, type_of_receipt, rate_limiter=rate_limiter)
+        self.downloader = DownloadCreatedReceipt(user_id, type_of_receipt, receipt_path, rate_limiter=rate_limiter)
+        self.records = {}
+        self.queued_ids = set()
+        self._rechecks = set()
+
+    def _recover(self):
+        if self.resolved_pinfls:
+            self.journal.resolve(self.resolved_pinfls)
+        self.in_doubt = self.journal.recover(UpdateReceiptsStatus(self.user_id, self.type_of_receipt))
+
+    def _load_chunk(self, df):
+        df = df.dropna(how='all')
+        if df.empty:
+            return []
+        validate_receipt(df)
+        rows_list, amounts = prepare_receipts_frame(df, self.type_of_receipt)
+        if not rows_list:
+            return []
+        session = Session()
+        try:
+            with session.begin():
+                bulk_upsert_receipts(session, rows_list, amounts, self.user_id, self.type_of_receipt)
+        finally:
+            session.close()
+        pinfls = [str(row[7]) for row in rows_list]
+        return [
+            record for record in
+            GetDataDB(self.user_id, self.type_of_receipt).iter_data_from_db_to_create_receipts(pinfls=pinfls)
+            if record.pinfl_of_debtor not in self.in_doubt
+        ]
+
+    async def _load_stage(self, create_queue):
+        chunks = iter_excel_chunks(self.file_path, self.chunk_size)
+        while True:
+            df = await asyncio.to_thread(next, chunks, None)
+            if df is None:
+                break
+            for record in await asyncio.to_thread(self._load_chunk, df):
+                if record.id in self.queued_ids:
+                    # ПИНФЛ повторяется в борде, а первая квитанция еще не записана в БД
+                    continue
+                self.queued_ids.add(record.id)
+                self.records[record.id] = record
+                await create_queue.put(record)
+                metrics.set_gauge('pipeline_queue_depth', create_queue.qsize(), stage='create')
+
+    async def _create_worker(self, session, create_queue, created):
+        while (record := await create_queue.get()) is not None:
+            await self.creator._async_create_receipt(session, record, created)
+
+    async def _recheck_later(self, check_queue, item):
+        try:
+            await asyncio.sleep(self.recheck_delay)
+            await check_queue.put(item)
+        finally:
+            self._rechecks.discard(asyncio.current_task())
+
+    async def _check(self, session, headers, item, check_queue, download_queue):
+        receipt_id, invoice, attempt = item
+        results = []
+        await self.checker._request((receipt_id, invoice), headers, session, results)
+        if results:
+            await asyncio.to_thread(self.checker._update_paid_receipts_in_db, results)
+        if results and results[0]['paid'] == 'PAID':
+            record = self.records.pop(receipt_id, None)
+            if record is not None:
+                await download_queue.put((record.fio, record.pinfl_of_debtor, invoice))
+            metrics.set_gauge('pipeline_queue_depth', download_queue.qsize(), stage='download')
+        elif attempt + 1 < self.max_checks:
+            self._rechecks.add(asyncio.create_task(
+                self._recheck_later(check_queue, (receipt_id, invoice, attempt + 1))
+            ))
+        else:
+            # Неоплаченные квитанции дальше проверяет фоновый поллер
+            self.records.pop(receipt_id, None)
+
+    async def _check_worker(self, session, check_queue, download_queue):
+        headers = self.checker.HEADERS.copy()
+        while (item := await check_queue.get()) is not None:
+            try:
+                await self._check(session, headers, item, check_queue, download_queue)
+            finally:
+                check_queue.task_done()
+
+    async def _download_worker(self, session, download_queue):
+        semaphore = asyncio.Semaphore(1)
+        while (item := await download_queue.get()) is not None:
+            fio, pinfl, invoice = item
+            await self.downloader.async_request_download_pdf(session, semaphore, invoice, fio, pinfl)
+
+    async def run(self):
+        create_queue = asyncio.Queue(self.queue_size)
+        check_queue = asyncio.Queue(self.queue_size)
+        download_queue = asyncio.Queue(self.queue_size)
+
+        async def _on_committed(updated):
+            for created_receipt in updated:
+                await check_queue.put((created_receipt.id, created_receipt.invoice, 0))
+            metrics.set_gauge('pipeline_queue_depth', check_queue.qsize(), stage='check')
+
+        self.creator.on_committed = _on_committed
+        await asyncio.to_thread(self._recover)
+        created = []
+        session = await self.creator.get_http_session()
+
+        creators = [asyncio.create_task(self._create_worker(session, create_queue, created))
+                    for _ in range(self.create_workers)]
+        checkers = [asyncio.create_task(self._check_worker(session, check_queue, download_queue))
+                    for _ in range(self.check_workers)]
+        downloaders = [asyncio.create_task(self._download_worker(session, download_queue))
+                       for _ in range(self.download_workers)]
+        try:
+            await self._load_stage(create_queue)
+            for _ in creators:
+                await create_queue.put(None)
+            await asyncio.gather(*creators)
+            if created:
+                await self.creator._async_flush_created(created)
+
+            # Очередь пуста и отложенных проверок нет - новых квитанций на проверку не будет
+            while True:
+                await check_queue.join()
+                if not self._rechecks:
+                    break
+                await asyncio.wait(set(self._rechecks))
+            for _ in checkers:
+                await check_queue.put(None)
+            await asyncio.gather(*checkers)
+
+            for _ in downloaders:
+                await download_queue.put(None)
+            await asyncio.gather(*downloaders)
+            await asyncio.to_thread(self.journal.compact)
+        finally:
+            for task in creators + checkers + downloaders + list(self._rechecks):
+                task.cancel()
+            self.downloader.manifest.save()
+            self.creator.flush_reports()
+
+
+def run_pipeline(user_id, type_of_receipt, file_path, receipt_path, modal_window, **kwargs):
+    package_logger = logging.getLogger(__package__)
+    modal_handler = attach_modal_log_handler(package_logger, modal_window)
+    SharedHttpClient.enter()
+    try:
+        pipeline = ReceiptPipeline(user_id, type_of_receipt, file_path, receipt_path, **kwargs)
+        with metrics.timer('stage_seconds', stage='pipeline'):
+            pipeline.creator.run_in_loop(pipeline.run())
+        logger.info('Обработка борда завершена')
+    except Exception as e:
+        logger.error(f"Ошибка при обработке борда: {e}",
+                     extra={'user_message': 'Обнаружены проблемы при обработке борда'})
+        raise e
+    finally:
+        SharedHttpClient.leave()
+        detach_modal_log_handler(package_logger, modal_handler)
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import aiohttp
+from sqlalchemy import and_, inspect, or_, update
+
+from database import Session
+from models import Receipt, PaidStatusEnum
+from .base import CheckPaidReceipt
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentStatusPoller(CheckPaidReceipt):
+    """Фоновая проверка оплаты: каждая квитанция проверяется по своему расписанию (Receipt.next_check_at).
+
+    Свежие CHECKING проверяются часто, давно созданные CREATED - редко, PAID больше не проверяются.
+    """
+    CHECKING_INTERVAL = timedelta(minutes=5)
+    CREATED_INTERVALS = (
+        (timedelta(days=1), timedelta(minutes=30)),
+        (timedelta(days=7), timedelta(hours=6)),
+    )
+    CREATED_MAX_INTERVAL = timedelta(days=1)
+
+    def __init__(self, user_id, type_of_sud, idle_interval=60, batch_size=200, window=20):
+        super().__init__(user_id, type_of_sud)
+        self.idle_interval = idle_interval
+        self.batch_size = batch_size
+        self.window = window
+        self._session = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def check_schema():
+        """Поллеру нужна колонка Receipt.next_check_at: она добавляется в models вместе с миграцией БД."""
+        if not hasattr(Receipt, 'next_check_at'):
+            raise RuntimeError('В модели Receipt нет колонки next_check_at, фоновая проверка оплаты недоступна')
+        session = Session()
+        try:
+            columns = {column['name'] for column in inspect(session.get_bind()).get_columns(Receipt.__tablename__)}
+        finally:
+            session.close()
+        if 'next_check_at' not in columns:
+            raise RuntimeError(f'В таблице {Receipt.__tablename__} нет колонки next_check_at, выполните миграцию БД')
+
+    def get_next_check_at(self, paid, receipt_created_at, now):
+        if paid == PaidStatusEnum.CHECKING:
+            return now + self.CHECKING_INTERVAL
+        age = now - receipt_created_at if receipt_created_at else timedelta.max
+        for max_age, interval in self.CREATED_INTERVALS:
+            if age < max_age:
+                return now + interval
+        return now + self.CREATED_MAX_INTERVAL
+
+    def get_due_receipts(self):
+        now = datetime.now()
+        session = Session()
+        try:
+            rows = session.query(
+                Receipt.id, Receipt.number_of_receipt, Receipt.paid, Receipt.receipt_created_at
+            ).filter(
+                and_(
+                    Receipt.status_of_created == True,
+                    Receipt.type_of_sud == self.type_of_sud,
+                    Receipt.paid.in_([PaidStatusEnum.CHECKING, PaidStatusEnum.CREATED]),
+                    Receipt.user_id == self.user_id,
+                    or_(Receipt.next_check_at == None, Receipt.next_check_at <= now),
+                )
+            ).order_by(Receipt.next_check_at.nullsfirst()).limit(self.batch_size).all()
+        finally:
+            session.close()
+        return rows
+
+    def _update_schedule_in_db(self, rows, results):
+        now = datetime.now()
+        results_by_id = {result['id']: result for result in results}
+        updates = []
+        for row in rows:
+            result = results_by_id.get(row.id, {'id': row.id})
+            paid = result.get('paid', row.paid)
+            if paid == 'PAID' or paid == PaidStatusEnum.PAID:
+                result['next_check_at'] = None
+            else:
+                status = PaidStatusEnum.CHECKING if paid == 'CHECKING' else paid
+                result['next_check_at'] = self.get_next_check_at(status, row.receipt_created_at, now)
+            updates.append(result)
+
+        session = Session()
+        try:
+            session.execute(update(Receipt), updates)
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка обновления расписания проверки квитанций: {e}",
+                         extra={"user_message": "Ошибка при обновлении квитанций в БД"})
+            return False
+        finally:
+            session.close()
+
+    async def get_http_session(self):
+        # Поллер работает в своем потоке и event loop, поэтому у него своя сессия
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def poll_once(self):
+        rows = await asyncio.to_thread(self.get_due_receipts)
+        if not rows:
+            return 0
+        headers = self.HEADERS.copy()
+        session = await self.get_http_session()
+        semaphore = asyncio.Semaphore(self.window)
+        results = []
+
+        async def _check(row):
+            async with semaphore:
+                await self._request((row.id, row.number_of_receipt), headers, session, results)
+
+        await asyncio.gather(*[_check(row) for row in rows])
+        if not await asyncio.to_thread(self._update_schedule_in_db, rows, results):
+            # Расписание не сохранено: без паузы та же пачка сразу ушла бы в биллинг повторно
+            return 0
+        return len(rows)
+
+    async def run_forever(self):
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    checked = await self.poll_once()
+                except Exception as e:
+                    logger.error(f"Ошибка фоновой проверки оплаты: {e}")
+                    checked = 0
+                if not checked:
+                    await asyncio.to_thread(self._stop_event.wait, self.idle_interval)
+        finally:
+            if self._session is not None:
+                await self._session.close()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self.check_schema()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=asyncio.run, args=(self.run_forever(),),
+                                        name=f'payment-poller-{self.user_id}', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
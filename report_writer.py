@@ -0,0 +1,71 @@
+import logging
+import os
+
+from openpyxl import load_workbook
+from openpyxl.workbook import Workbook
+
+logger = logging.getLogger(__name__)
+
+
+class ExcelReportWriter:
+    """Копит строки отчета в памяти и записывает их в .xlsx одним проходом (write-only)."""
+
+    def __init__(self, filename, headers, flush_every=None):
+        self.filename = filename
+        self.headers = headers
+        self.flush_every = flush_every
+        self.rows = []
+
+    def append(self, data):
+        self.rows.append(list(data))
+        if self.flush_every and len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def _read_existing_rows(self):
+        if not os.path.exists(self.filename):
+            return [self.headers]
+        wb = load_workbook(self.filename, read_only=True)
+        try:
+            return [list(row) for row in wb.active.iter_rows(values_only=True)]
+        finally:
+            wb.close()
+
+    def flush(self):
+        if not self.rows:
+            return
+        existing_rows = self._read_existing_rows()
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        for row in existing_rows:
+            ws.append(row)
+        for row in self.rows:
+            ws.append(row)
+
+        tmp_filename = f'{self.filename}.tmp'
+        wb.save(tmp_filename)
+        os.replace(tmp_filename, self.filename)
+        logger.debug(f'В отчет {self.filename} записано строк: {len(self.rows)}')
+        self.rows.clear()
+
+
+class ReportWriterMixin:
+    REPORT_HEADERS = []
+    REPORT_FLUSH_EVERY = None
+
+    def _get_report_writer(self, filename):
+        if filename not in self.report_writers:
+            self.report_writers[filename] = ExcelReportWriter(filename, self.REPORT_HEADERS,
+                                                              flush_every=self.REPORT_FLUSH_EVERY)
+        return self.report_writers[filename]
+
+    def _write_to_excel(self, data, filename):
+        self._get_report_writer(filename).append(data)
+
+    def flush_reports(self):
+        for writer in self.report_writers.values():
+            try:
+                writer.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи отчета {writer.filename}: {e}",
+                             extra={"user_message": f"Ошибка записи отчета {writer.filename}"})
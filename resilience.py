@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+import requests
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RetryPolicy:
+    """Экспоненциальная задержка с jitter; учитывает Retry-After из ответа сервера."""
+
+    def __init__(self, max_retries=3, base_delay=1.0, max_delay=60.0,
+                 retry_statuses=(429, 500, 502, 503, 504), retry_on_connection_error=True):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+        self.retry_on_connection_error = retry_on_connection_error
+
+    def should_retry(self, exc):
+        status = get_status(exc)
+        if status is not None:
+            return status in self.retry_statuses
+        return self.retry_on_connection_error and is_connection_error(exc)
+
+    def get_delay(self, attempt, exc):
+        retry_after = get_retry_after(exc)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Приостанавливает все запросы, если доля ошибок в последних window вызовах превышает error_rate."""
+
+    def __init__(self, window=50, min_calls=10, error_rate=0.5, pause=30.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.pause = pause
+        self.calls = deque(maxlen=window)
+        self.opened_until = 0.0
+
+    def record(self, success):
+        self.calls.append(success)
+        if len(self.calls) < self.min_calls:
+            return
+        failures = self.calls.count(False)
+        if failures / len(self.calls) >= self.error_rate and time.monotonic() >= self.opened_until:
+            self.opened_until = time.monotonic() + self.pause
+            self.calls.clear()
+            metrics.inc('billing_circuit_breaker_open_total')
+            logger.error(f'Слишком много ошибок от сервера, запросы приостановлены на {self.pause} сек.',
+                         extra={"user_message": f'Сервер отвечает с ошибками, пауза {self.pause} сек.'})
+
+    def get_pause(self):
+        return max(0.0, self.opened_until - time.monotonic())
+
+    def wait(self):
+        while pause := self.get_pause():
+            time.sleep(pause)
+
+    async def async_wait(self):
+        while pause := self.get_pause():
+            await asyncio.sleep(pause)
+
+
+RETRY_POLICIES = {
+    # Повтор создания только при явном отказе сервера, чтобы не создать квитанцию дважды
+    'create': RetryPolicy(max_retries=3, retry_statuses=(429, 503), retry_on_connection_error=False),
+    'check': RetryPolicy(max_retries=3),
+    'download': RetryPolicy(max_retries=3),
+}
+
+billing_circuit_breaker = CircuitBreaker()
+
+
+def get_status(exc):
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code
+    return None
+
+
+def is_client_error(exc):
+    status = get_status(exc)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def get_retry_after(exc):
+    headers = None
+    if isinstance(exc, aiohttp.ClientResponseError):
+        headers = exc.headers
+    elif isinstance(exc, requests.HTTPError) and exc.response is not None:
+        headers = exc.response.headers
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_connection_error(exc):
+    return isinstance(exc, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ServerDisconnectedError,
+                            requests.ConnectionError, requests.Timeout))
+
+
+def call_with_retry(endpoint, func, *args, breaker=billing_circuit_breaker, **kwargs):
+    policy = RETRY_POLICIES[endpoint]
+    attempt = 0
+    while True:
+        breaker.wait()
+        try:
+            with metrics.in_flight('billing_requests_in_flight', endpoint=endpoint), \
+                    metrics.timer('billing_request_seconds', endpoint=endpoint):
+                result = func(*args, **kwargs)
+        except Exception as e:
+            metrics.inc('billing_errors_total', endpoint=endpoint, status=get_status(e) or type(e).__name__)
+            # Отказ 4xx - ошибка запроса, а не сервера: на автомат не влияет
+            breaker.record(is_client_error(e))
+            retryable = policy.should_retry(e)
+            if not retryable or attempt >= policy.max_retries:
+                raise
+            delay = policy.get_delay(attempt, e)
+            attempt += 1
+            metrics.inc('billing_retries_total', endpoint=endpoint)
+            logger.info(f'Повтор запроса {endpoint} через {delay:.1f} сек. (попытка {attempt}): {e}')
+            time.sleep(delay)
+        else:
+            breaker.record(True)
+            return result
+
+
+async def async_call_with_retry(endpoint, func, *args, breaker=billing_circuit_breaker, **kwargs):
+    policy = RETRY_POLICIES[endpoint]
+    attempt = 0
+    while True:
+        await breaker.async_wait()
+        try:
+            with metrics.in_flight('billing_requests_in_flight', endpoint=endpoint), \
+                    metrics.timer('billing_request_seconds', endpoint=endpoint):
+                result = await func(*args, **kwargs)
+        except Exception as e:
+            metrics.inc('billing_errors_total', endpoint=endpoint, status=get_status(e) or type(e).__name__)
+            # Отказ 4xx - ошибка запроса, а не сервера: на автомат не влияет
+            breaker.record(is_client_error(e))
+            retryable = policy.should_retry(e)
+            if not retryable or attempt >= policy.max_retries:
+                raise
+            delay = policy.get_delay(attempt, e)
+            attempt += 1
+            metrics.inc('billing_retries_total', endpoint=endpoint)
+            logger.info(f'Повтор запроса {endpoint} через {delay:.1f} сек. (попытка {attempt}): {e}')
+            await asyncio.sleep(delay)
+        else:
+            breaker.record(True)
+            return result
@@ -0,0 +1,234 @@
+import asyncio
+import itertools
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .base import TokenBucket, run_check_paid_receipt
+from . import creation_post_receipts_civil
+from . import download_created_receipts
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class FairRateLimiter:
+    """Общий лимит запросов к биллингу, который делится между пользователями по весам (smooth weighted round-robin)."""
+
+    def __init__(self, rate, burst=1):
+        self.bucket = TokenBucket(rate, burst)
+        self.weights = {}
+        self.current = Counter()
+        self.granted = Counter()
+        self.waiters = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def set_weight(self, key, weight):
+        with self._cond:
+            self.weights[key] = weight
+
+    def for_user(self, key):
+        return UserRateLimiter(self, key)
+
+    def get_waiting(self):
+        with self._cond:
+            return {key: len(waiters) for key, waiters in self.waiters.items() if waiters}
+
+    def _wait(self, key, release):
+        with self._cond:
+            self.waiters.setdefault(key, deque()).append(release)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch, name='fair-rate-limiter', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _cancel(self, key, release):
+        with self._cond:
+            try:
+                self.waiters.get(key, deque()).remove(release)
+            except ValueError:
+                pass
+
+    def _pick_key(self):
+        keys = [key for key, waiters in self.waiters.items() if waiters]
+        total = 0
+        for key in keys:
+            weight = self.weights.get(key, 1)
+            self.current[key] += weight
+            total += weight
+        key = max(keys, key=lambda k: self.current[k])
+        self.current[key] -= total
+        return key
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not any(self.waiters.values()):
+                    self._cond.wait()
+            self.bucket.acquire()
+            with self._cond:
+                if not any(self.waiters.values()):
+                    # Все ожидающие отменили запрос, пока поток ждал токен
+                    continue
+                key = self._pick_key()
+                release = self.waiters[key].popleft()
+                self.granted[key] += 1
+            try:
+                release()
+            except Exception as e:
+                # Например, event loop ожидающего уже закрыт; поток раздачи должен продолжать работу
+                logger.error(f'Не удалось выдать токен ожидающему пользователя {key}: {e}')
+
+
+class UserRateLimiter:
+    """Тот же интерфейс, что у TokenBucket, но в рамках доли пользователя в FairRateLimiter."""
+
+    def __init__(self, limiter, key):
+        self.limiter = limiter
+        self.key = key
+
+    def acquire(self):
+        event = threading.Event()
+        self.limiter._wait(self.key, event.set)
+        event.wait()
+
+    async def async_acquire(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _release():
+            if not future.done():
+                future.set_result(None)
+
+        def release():
+            loop.call_soon_threadsafe(_release)
+
+        self.limiter._wait(self.key, release)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self.limiter._cancel(self.key, release)
+            raise
+
+
+class Job:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    _ids = itertools.count(1)
+
+    def __init__(self, kind, user_id, type_of_receipt, kwargs):
+        self.id = next(self._ids)
+        self.kind = kind
+        self.user_id = user_id
+        self.type_of_receipt = type_of_receipt
+        self.kwargs = kwargs
+        self.status = self.QUEUED
+        self.error = None
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'user_id': self.user_id,
+            'type_of_receipt': self.type_of_receipt,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobScheduler:
+    """Очереди задач по (user_id, type_of_receipt), выполнение в пуле потоков с общим лимитом запросов.
+
+    Задачи одного пользователя и типа выполняются по очереди, разные пользователи - параллельно.
+    """
+    JOB_FUNCTIONS = {
+        'create': creation_post_receipts_civil.run,
+        'check': run_check_paid_receipt,
+        'download': download_created_receipts.run,
+    }
+
+    def __init__(self, workers=4, rate=2, burst=5):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='receipt-job')
+        self.limiter = FairRateLimiter(rate, burst)
+        self.queues = {}
+        self.active_keys = set()
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._next_keys = deque()
+
+    def submit(self, kind, user_id, type_of_receipt, weight=None, **kwargs):
+        if kind not in self.JOB_FUNCTIONS:
+            raise ValueError(f'Неизвестный тип задачи: {kind}')
+        if weight is not None:
+            self.limiter.set_weight(user_id, weight)
+        job = Job(kind, user_id, type_of_receipt, kwargs)
+        key = (user_id, type_of_receipt)
+        with self._lock:
+            self.jobs[job.id] = job
+            if key not in self.queues:
+                self.queues[key] = deque()
+                self._next_keys.append(key)
+            self.queues[key].append(job)
+            metrics.set_gauge('scheduler_queue_depth', len(self.queues[key]), user_id=user_id,
+                              type_of_receipt=getattr(type_of_receipt, 'name', type_of_receipt))
+            self._dispatch()
+        logger.info(f'Задача {job.id} ({kind}) для пользователя {user_id} поставлена в очередь')
+        return job
+
+    def _dispatch(self):
+        # Вызывается под self._lock; ключи перебираются по кругу, чтобы пользователи запускались по очереди
+        for _ in range(len(self._next_keys)):
+            if len(self.active_keys) >= self.workers:
+                return
+            key = self._next_keys[0]
+            self._next_keys.rotate(-1)
+            if key in self.active_keys or not self.queues[key]:
+                continue
+            job = self.queues[key].popleft()
+            metrics.set_gauge('scheduler_queue_depth', len(self.queues[key]), user_id=key[0],
+                              type_of_receipt=getattr(key[1], 'name', key[1]))
+            self.active_keys.add(key)
+            self.executor.submit(self._run_job, key, job)
+
+    def _run_job(self, key, job):
+        job.status = Job.RUNNING
+        job.started_at = datetime.now()
+        try:
+            self.JOB_FUNCTIONS[job.kind](job.user_id, job.type_of_receipt,
+                                         rate_limiter=self.limiter.for_user(job.user_id), **job.kwargs)
+            job.status = Job.DONE
+        except Exception as e:
+            job.status = Job.FAILED
+            job.error = str(e)
+            logger.error(f'Задача {job.id} ({job.kind}) для пользователя {job.user_id} завершилась с ошибкой: {e}')
+        finally:
+            job.finished_at = datetime.now()
+            with self._lock:
+                self.active_keys.discard(key)
+                self._dispatch()
+
+    def get_status(self):
+        with self._lock:
+            return {
+                'queue_depth': {key: len(queue) for key, queue in self.queues.items() if queue},
+                'running': [job.to_dict() for job in self.jobs.values() if job.status == Job.RUNNING],
+                'jobs': [job.to_dict() for job in self.jobs.values()],
+                'requests_granted': dict(self.limiter.granted),
+                'requests_waiting': self.limiter.get_waiting(),
+            }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+TERMINAL_STATUSES = ('PAID',)
+
+
+class StatusCache:
+    """Кэш статусов квитанций с объединением одновременных запросов (single-flight).
+
+    Пока запрос по квитанции выполняется, остальные вызовы по ней ждут его результат, в том числе из
+    других потоков и event loop. Конечный статус (PAID) хранится без срока, остальные - ttl секунд.
+    """
+
+    def __init__(self, ttl=20, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.results = OrderedDict()
+        self.in_flight = {}
+        self._lock = threading.Lock()
+
+    def _get_cached(self, invoice):
+        cached = self.results.get(invoice)
+        if cached is None:
+            return None
+        response_data, expires_at = cached
+        if expires_at is not None and expires_at < time.monotonic():
+            del self.results[invoice]
+            return None
+        self.results.move_to_end(invoice)
+        return response_data
+
+    def _store(self, invoice, response_data):
+        if response_data is None:
+            return
+        terminal = response_data.get('invoiceStatus') in TERMINAL_STATUSES
+        with self._lock:
+            self.results[invoice] = (response_data, None if terminal else time.monotonic() + self.ttl)
+            self.results.move_to_end(invoice)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+    async def get_status(self, invoice, fetch):
+        with self._lock:
+            response_data = self._get_cached(invoice)
+            if response_data is not None:
+                return response_data
+            future = self.in_flight.get(invoice)
+            owner = future is None
+            if owner:
+                future = self.in_flight[invoice] = Future()
+
+        if not owner:
+            return await asyncio.wrap_future(future)
+
+        try:
+            response_data = await fetch()
+            self._store(invoice, response_data)
+            future.set_result(response_data)
+            return response_data
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self.in_flight.pop(invoice, None)
+
+    def invalidate(self, invoice):
+        with self._lock:
+            self.results.pop(invoice, None)
+
+
+status_cache = StatusCache()